@@ -29,7 +29,7 @@ class Block:
             noonce=noonce,
             previousHash=previousHash)
 
-    def asJSON(self) -> str:
+    def asDict(self) -> dict:
         d = {
             "hash": self.hash,
             "index": self.index,
@@ -43,7 +43,10 @@ class Block:
             dTransactions = cast(List[Transaction], d["transactions"])
             dTransactions.append(transaction.asDict())
 
-        return json.dumps(d, indent=4)
+        return d
+
+    def asJSON(self) -> str:
+        return json.dumps(self.asDict(), indent=4)
 
     def __repr__(self) -> str:
         return self.asJSON()
@@ -1,7 +1,10 @@
+import abc
 import json
-from typing import Dict, Tuple, List, cast, Set
+from typing import Deque, Dict, Tuple, List, cast, Set
+from collections import deque
 
 import sys, os
+from itertools import islice
 
 # Add the path to the parent directory of 'blockchain'
 sys.path.append(os.path.abspath('../blockchain'))
@@ -12,6 +15,7 @@ import block as block
 from mine import hasProofOfWork, checkProofOfWork
 import transaction as transaction
 import block as chain_helper
+from Cryptodome.Hash import SHA256
 
 
 class ChainException(Exception):
@@ -32,63 +36,393 @@ class UTXOException(ChainException):
     pass
 
 
+class StaleBlockException(ChainException):
+    pass
+
+
+ADDRESS_DIGEST_SIZE = 8  # bytes of the address hash used as index key
+
+
+def addressDigest(address: str) -> bytes:
+    """
+    Addresses are DER encoded public keys that are hundreds of characters
+    long. The address index keys on a short digest of them instead.
+    """
+    return SHA256.new(address.encode('utf-8')).digest()[:ADDRESS_DIGEST_SIZE]
+
+
+def outpointKey(txHash: str, outputIndex: int) -> bytes:
+    """
+    Packs an outpoint into 36 bytes: the raw transaction hash followed by
+    the output index. Returns None for references that can not exist.
+    """
+    if not isinstance(outputIndex, int) or outputIndex < 0 or outputIndex >= 2 ** 32:
+        return None
+    try:
+        rawHash = bytes.fromhex(txHash)
+    except (TypeError, ValueError):
+        return None
+    return rawHash + outputIndex.to_bytes(4, 'big')
+
+
+def splitOutpointKey(key: bytes) -> Tuple[str, int]:
+    return key[:-4].hex(), int.from_bytes(key[-4:], 'big')
+
+
+class AddressIndex:
+    """
+    Maps address digests to the unspent outputs that belong to them. Each
+    output is stored as outpoint key -> amount.
+    """
+
+    def __init__(self):
+        self.outputs: Dict[bytes, Dict[bytes, float]] = {}
+
+    def add(self, address: str, key: bytes, amount: float) -> None:
+        digest = addressDigest(address)
+        entries = self.outputs.get(digest, None)
+        if entries is None:
+            entries = {}
+            self.outputs[digest] = entries
+        entries[key] = amount
+
+    def remove(self, address: str, key: bytes) -> None:
+        digest = addressDigest(address)
+        entries = self.outputs.get(digest, None)
+        if entries is None:
+            return
+        entries.pop(key, None)
+        if len(entries) == 0:
+            del self.outputs[digest]
+
+    def getBalance(self, address: str) -> float:
+        return sum(self.outputs.get(addressDigest(address), {}).values())
+
+    def getCount(self, address: str) -> int:
+        return len(self.outputs.get(addressDigest(address), {}))
+
+    def getOutputs(
+            self,
+            address: str,
+            offset: int = 0,
+            limit: int = -1) -> List[Tuple[str, int, float]]:
+        """
+        Returns a page of (transaction hash, output index, amount) for the
+        unspent outputs of an address, oldest first.
+        """
+        entries = self.outputs.get(addressDigest(address), {})
+        stop = None if limit < 0 else offset + limit
+        return [
+            splitOutpointKey(key) + (amount,)
+            for key, amount in islice(entries.items(), offset, stop)]
+
+
+class UnspentOutput:
+    """
+    The part of a transaction output the UTXO set needs to keep: the amount
+    and the id of its address in the AddressTable.
+    """
+    __slots__ = ("amount", "addressId")
+
+    def __init__(self, amount: float, addressId: int) -> None:
+        self.amount = amount
+        self.addressId = addressId
+
+
+class AddressTable:
+    """
+    Interns addresses so that unspent outputs only hold a small integer id
+    instead of their own copy of a several hundred character address.
+    Ids are reference counted and reused once nothing points to them.
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.addresses: List[str] = []
+        self.references: List[int] = []
+        self.free: List[int] = []
+
+    def acquire(self, address: str) -> int:
+        addressId = self.ids.get(address, None)
+        if addressId is None:
+            if self.free:
+                addressId = self.free.pop()
+                self.addresses[addressId] = address
+                self.references[addressId] = 0
+            else:
+                addressId = len(self.addresses)
+                self.addresses.append(address)
+                self.references.append(0)
+            self.ids[address] = addressId
+
+        self.references[addressId] += 1
+        return addressId
+
+    def release(self, addressId: int) -> None:
+        self.references[addressId] -= 1
+        if self.references[addressId] == 0:
+            del self.ids[self.addresses[addressId]]
+            self.addresses[addressId] = None
+            self.free.append(addressId)
+
+    def get(self, addressId: int) -> str:
+        return self.addresses[addressId]
+
+
+class UTXOBackend(abc.ABC):
+    """
+    Storage interface for the unspent outputs of a UTXOManager. Outputs
+    are keyed by outpoint key (see outpointKey) and stored as an
+    (amount, address) pair.
+
+    Backends that persist their state get flush() called at every block
+    boundary with the hash of the new chain tip.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: bytes) -> Tuple[float, str]:
+        """
+        Returns the (amount, address) of an unspent output, or None.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add(self, key: bytes, amount: float, address: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, key: bytes) -> Tuple[float, str]:
+        """
+        Removes an unspent output and returns its (amount, address), or
+        None if it is not unspent.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def items(self):
+        """
+        Yields (key, amount, address) for every unspent output.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def getAddressOutputs(
+            self,
+            address: str,
+            offset: int = 0,
+            limit: int = -1) -> List[Tuple[str, int, float]]:
+        """
+        Returns a page of (transaction hash, output index, amount) for the
+        unspent outputs of an address.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def getAddressCount(self, address: str) -> int:
+        raise NotImplementedError
+
+    def getBalance(self, address: str) -> float:
+        return sum(amount for _, _, amount in self.getAddressOutputs(address))
+
+    def flush(self, tipHash: str) -> None:
+        pass
+
+    def bestBlock(self) -> str:
+        """
+        Returns the chain tip the persisted state belongs to, or None.
+        """
+        return None
+
+
+class MemoryUTXOBackend(UTXOBackend):
+    """
+    Keeps the whole UTXO set in a dictionary of outpoint key ->
+    UnspentOutput, with an in-memory address index next to it.
+    """
+
+    def __init__(self):
+        self.utxo: Dict[bytes, UnspentOutput] = {}
+        self.addressTable = AddressTable()
+        self.addresses = AddressIndex()
+
+    def get(self, key: bytes) -> Tuple[float, str]:
+        output = self.utxo.get(key, None)
+        if output is None:
+            return None
+        return output.amount, self.addressTable.get(output.addressId)
+
+    def add(self, key: bytes, amount: float, address: str) -> None:
+        old = self.utxo.get(key, None)
+        if old is not None:
+            self.addressTable.release(old.addressId)
+        self.utxo[key] = UnspentOutput(amount, self.addressTable.acquire(address))
+        self.addresses.add(address, key, amount)
+
+    def remove(self, key: bytes) -> Tuple[float, str]:
+        output = self.utxo.pop(key, None)
+        if output is None:
+            return None
+        address = self.addressTable.get(output.addressId)
+        self.addresses.remove(address, key)
+        self.addressTable.release(output.addressId)
+        return output.amount, address
+
+    def items(self):
+        for key, output in self.utxo.items():
+            yield key, output.amount, self.addressTable.get(output.addressId)
+
+    def __len__(self) -> int:
+        return len(self.utxo)
+
+    def getAddressOutputs(
+            self,
+            address: str,
+            offset: int = 0,
+            limit: int = -1) -> List[Tuple[str, int, float]]:
+        return self.addresses.getOutputs(address, offset, limit)
+
+    def getAddressCount(self, address: str) -> int:
+        return self.addresses.getCount(address)
+
+    def getBalance(self, address: str) -> float:
+        return self.addresses.getBalance(address)
+
+
 class UTXOManager:
     """
-    The UTXO manager provides access to get referenced transactions from
-    new transactions.
+    The UTXO manager keeps the set of unspent transaction outputs and
+    decides whether new transactions can spend them.
 
-    It is implelmented as a dictionary mapping from transation hash to
-    a tuple pair of transaction and a list of unspent indices.
+    The outputs themselves live in a UTXOBackend, by default the in-memory
+    MemoryUTXOBackend. Only the amount and the address of an output are
+    kept, whole transactions never are.
+
+    spend() returns the outputs a transaction consumed. The outputs spent
+    by a whole block form its undo record, which is all disconnectBlock()
+    needs to restore the state before the block.
 
     Note: None of these methods validate that the transaction's hash
     matches the corresponding data.
     """
 
-    def __init__(self):
-        self.utxo: Dict[str, Tuple[transaction.Transaction, Set[int]]] = {}
+    def __init__(self, backend: UTXOBackend = None):
+        self.backend = backend if backend is not None else MemoryUTXOBackend()
+
+    def __len__(self) -> int:
+        return len(self.backend)
+
+    def getOutput(self, txHash: str, outputIndex: int) -> Tuple[float, str]:
+        """
+        Returns the (amount, address) of an unspent output, or None.
+        """
+        key = outpointKey(txHash, outputIndex)
+        if key is None:
+            return None
+        return self.backend.get(key)
+
+    def getBalance(self, address: str) -> float:
+        return self.backend.getBalance(address)
+
+    def getAddressOutputs(
+            self,
+            address: str,
+            offset: int = 0,
+            limit: int = -1) -> List[Tuple[str, int, float]]:
+        return self.backend.getAddressOutputs(address, offset, limit)
+
+    def getAddressCount(self, address: str) -> int:
+        return self.backend.getAddressCount(address)
 
-    def spend(self, newTransaction: transaction.Transaction) -> None:
+    def flush(self, tipHash: str) -> None:
+        self.backend.flush(tipHash)
+
+    def spend(
+            self,
+            newTransaction: transaction.Transaction) \
+            -> List[Tuple[bytes, float, str]]:
         """
         Spends a transaction and updates the internal cache of utxos.
+        Returns the (outpoint key, amount, address) of every output it
+        consumed, in input order, which revert() needs to undo it.
 
         A transaction should be verified before it is spent. If this is not
         the case, then it could create an invalid and confusing utxo state.
         Spent transactions are invalid.
 
         """
+        spent = []
         for tInput in newTransaction.inputs:
-            self._spendInput(tInput)
+            spent.append(self._spendInput(tInput))
+
+        for i, tOutput in enumerate(newTransaction.outputs):
+            self.backend.add(
+                outpointKey(newTransaction.hash, i),
+                tOutput.amount,
+                tOutput.address)
+        return spent
+
+    def connectBlock(self, newBlock: block.Block) -> List[Tuple[bytes, float, str]]:
+        """
+        Spends every transaction of an already verified block and returns
+        the undo record of the block: the outputs it consumed, in order.
+        """
+        undo = []
+        for tx in newBlock.transactions:
+            undo.extend(self.spend(tx))
+        return undo
 
-        unspentOutputIndices = set(range(len(newTransaction.outputs)))
-        self.utxo[newTransaction.hash] = (newTransaction, unspentOutputIndices)
+    def disconnectBlock(
+            self,
+            oldBlock: block.Block,
+            undo: List[Tuple[bytes, float, str]]) -> None:
+        """
+        Reverts a block, newest transaction first, using its undo record.
+        """
+        end = len(undo)
+        for tx in reversed(oldBlock.transactions):
+            start = end - len(tx.inputs)
+            if start < 0:
+                raise UTXOException("Undo record does not match the block.")
+            self.revert(tx, undo[start:end])
+            end = start
+        if end != 0:
+            raise UTXOException("Undo record does not match the block.")
 
     def canSpend(
             self,
-            newTransaction: transaction.Transaction) -> Tuple[bool, str]:
+            newTransaction: transaction.Transaction,
+            checkSignatures: bool = True) -> Tuple[bool, str]:
         """
         Verifies if a transaction can be spent based on the current UTXO cache.
         This does not account for duplicate inputs, since that can be
-        done elsewhere.
+        done elsewhere. checkSignatures=False only checks the amounts.
         """
         inputAmounts = 0
         isCoinbase = len(newTransaction.inputs) == 0 \
                      and len(newTransaction.outputs) == 1
+        serializedOutputs = \
+            transaction.TransactionOutput.serializeMultiple(newTransaction.outputs)
 
         for i in range(len(newTransaction.inputs)):
             tInput = newTransaction.inputs[i]
-            referenced = self._getReference(tInput)
-            # print(f"referenced {referenced}")
+            referenced = self.getOutput(
+                tInput.referencedHash, tInput.referencedOutputIndex)
             if referenced is None:
                 return False, "Referenced UTXO does not exist."
 
+            amount, address = referenced
             # Verify that the signature is correct
-            isValid, msg = transaction.verifyTransactionInput(
-                referenced, newTransaction, i)
-            if not isValid:
-                return False, msg
+            if checkSignatures:
+                isValid, msg = transaction.verifyInputSignature(
+                    address, newTransaction, i, serializedOutputs)
+                if not isValid:
+                    return False, msg
 
-            inputAmounts += \
-                referenced.outputs[tInput.referencedOutputIndex].amount
+            inputAmounts += amount
 
         outputAmounts = \
             sum([output.amount for output in newTransaction.outputs])
@@ -100,130 +434,273 @@ class UTXOManager:
 
         return True, ""
 
-    def revert(self, tx: transaction.Transaction):
+    def revert(
+            self,
+            tx: transaction.Transaction,
+            spent: List[Tuple[bytes, float, str]]) -> None:
         """
-        Reverts the effect of a transaction from a UTXO.
+        Reverts the effect of a transaction from a UTXO, given the outputs
+        spend() returned for it.
         If the transaction has not been "spent" yet, then using this method
         may cause the internal cache to become invalid.
         """
-        for tInput in tx.inputs:
-            entry = self.utxo.get(tInput.referencedHash, None)
-            if entry is None:
-                raise UTXOException(
-                    "Reference from reverted transaction does not exist.")
-
-            unspentOutputIndices = cast(Set[int], entry[1])
-            if tInput.referencedOutputIndex in unspentOutputIndices:
+        for key, _, _ in spent:
+            if self.backend.get(key) is not None:
                 raise UTXOException("Transaction index is already inspent.")
 
-            unspentOutputIndices.add(tInput.referencedOutputIndex)
+        for i in range(len(tx.outputs)):
+            self.backend.remove(outpointKey(tx.hash, i))
 
-        del self.utxo[tx.hash]
+        for key, amount, address in spent:
+            self.backend.add(key, amount, address)
 
-    def _getReference(
+    def outputs(self):
+        """
+        Yields (transaction hash, output index, amount, address) for every
+        unspent output. Used to write snapshots of the UTXO set.
+        """
+        for key, amount, address in self.backend.items():
+            yield splitOutpointKey(key) + (amount, address)
+
+    def loadOutput(self, txHash: str, outputIndex: int, amount: float, address: str) -> None:
+        """
+        Restores an output written by outputs(), without any validation.
+        """
+        self.backend.add(outpointKey(txHash, outputIndex), amount, address)
+
+    def _spendInput(
             self,
             transactionInput: transaction.TransactionInput) \
-            -> transaction.Transaction:
+            -> Tuple[bytes, float, str]:
         """
-        Gets a referenced transaction from the transaction input.
-
-        When spending a transaction input - do NOT use this method.
-        This does not update the internal cache of utxo objects. Instead,
-        use the spend() method instead.
+        Spends a UTXO. Will update the internal cache. Returns the outpoint
+        key, amount and address of the output that was spent.
         """
-        entry = self.utxo.get(transactionInput.referencedHash, None)
-        if entry is None:
-            return None
+        key = outpointKey(
+            transactionInput.referencedHash,
+            transactionInput.referencedOutputIndex)
+        output = self.backend.remove(key) if key is not None else None
+        if output is None:
+            raise UTXOException(
+                "Input can not be spent: referenced output is not unspent.")
 
-        tx = entry[0]
-        # print(f"tx {tx}, entry {entry}")
-        unspentOutputIndices = cast(Set[int], entry[1])
+        return (key,) + output
 
-        if transactionInput.referencedOutputIndex in unspentOutputIndices:
-            return tx
-        else:
-            print(f"entry {entry}")
-            print(f"transactionInput.referenced {transactionInput.referencedOutputIndex}")
-            print(f"unspentOutputIndices {unspentOutputIndices}")
 
-        return None
+class MemoryUndoStore:
+    """
+    Keeps the undo record of every connected block in memory, keyed by
+    block hash. A persistent store with the same put(blockHash, undo) and
+    get(blockHash) methods can be passed to the Chain instead.
+    """
+
+    def __init__(self):
+        self.records: Dict[str, List[Tuple[bytes, float, str]]] = {}
+
+    def put(self, blockHash: str, undo: List[Tuple[bytes, float, str]]) -> None:
+        self.records[blockHash] = undo
+
+    def get(self, blockHash: str) -> List[Tuple[bytes, float, str]]:
+        return self.records.get(blockHash, None)
+
 
-    def _spendInput(self, transactionInput: transaction.TransactionInput):
+class DifficultyTracker:
+    """
+    Keeps the running sums of the retarget formula over the blocks of a
+    chain, so the difficulty at a retarget height is known without walking
+    every block.
+
+    The formula averages the block times of every block in the order the
+    chain added them, side branches included. Adding a block extends the
+    sums in O(1) with the same float operations as walking the blocks,
+    which keeps the result bit for bit equal. The sums after each of the
+    last CHANGING_DIFF_TIME blocks are kept in a ring buffer, so removing
+    one of them only replays the blocks after it. Removing an older block
+    replays the whole chain.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        # (range_timestamps, previous_block_timestamp) before the oldest
+        # block in recent
+        self.base: Tuple[float, float] = (0, 0)
+        # (hash, index, timestamp, range_timestamps, previous_block_timestamp)
+        # of the last blocks added
+        self.recent: Deque[tuple] = deque()
+
+    def __len__(self) -> int:
+        return self.count
+
+    @staticmethod
+    def _extend(sums: Tuple[float, float], index: int, timestamp: float) -> Tuple[float, float]:
+        rangeTimestamps, previousTimestamp = sums
+        if timestamp is not None and index != 0:
+            nonceTime = timestamp - previousTimestamp
+            if nonceTime < MAX_CHANGING_INT:
+                rangeTimestamps += nonceTime
+            previousTimestamp = timestamp
+        return rangeTimestamps, previousTimestamp
+
+    def _sums(self) -> Tuple[float, float]:
+        return self.recent[-1][3:] if self.recent else self.base
+
+    def _append(self, blockHash: str, index: int, timestamp: float) -> None:
+        sums = self._extend(self._sums(), index, timestamp)
+        if len(self.recent) == CHANGING_DIFF_TIME:
+            self.base = self.recent.popleft()[3:]
+        self.recent.append((blockHash, index, timestamp) + sums)
+
+    def add(self, newBlock: block.Block) -> None:
+        self._append(newBlock.hash, newBlock.index, newBlock.timestamp)
+        self.count += 1
+
+    def rebuild(self, blocks) -> None:
         """
-        Spends a UTXO. Will update the internal cache.
+        Starts over from the given blocks, in the order they were added.
         """
-        entry = self.utxo.get(transactionInput.referencedHash, None)
-        if entry is None:
-            raise UTXOException("Input can not be spent: Invalid hash.")
+        self.count = 0
+        self.base = (0, 0)
+        self.recent.clear()
+        for oldBlock in blocks:
+            self.add(oldBlock)
 
-        tx = entry[0]
-        unspentOutputIndices = cast(Set[int], entry[1])
-        if transactionInput.referencedOutputIndex in unspentOutputIndices:
-            unspentOutputIndices.remove(transactionInput.referencedOutputIndex)
-        else:
-            raise UTXOException(
-                "Input can not be spent: matching " +
-                "hash does not have spendable index.")
-
-
-def get_update_diff(previous_block_diff: int, previous_blocks: Dict[str, block.Block]) -> int:
-    range_timestamps = 0
-    previous_block_timestamp = 0
-    range_count = len(previous_blocks)
-    
-    for cblock in previous_blocks.values():
-        block_data = json.loads(chain_helper.toJSON(cblock))
-        timestamp = block_data.get("timestamp")
-        if timestamp is not None and block_data.get("index", 0) != 0:
-            nonce_time = timestamp - previous_block_timestamp
-            if nonce_time < MAX_CHANGING_INT:
-                range_timestamps += nonce_time
-            previous_block_timestamp = timestamp
-    
-    average_block_mine = range_timestamps / range_count if range_count else BLOCK_TIME
-    minus_diff = average_block_mine / BLOCK_TIME
-    return int(MIN_MINING_DIFFICULTY + (previous_block_diff * MAX_CHANGING_DIFF) - (MAX_CHANGING_DIFF * minus_diff))
-
-
-
-def update_difficulty(current_block: block.Block, previous_blocks: Dict[str, block.Block]) -> int:
-    range_timestamps = 0
-    previous_block_timestamp = 0
-    range_count = len(previous_blocks)
-    previous_block_diff = checkProofOfWork(current_block.previousHash)
-    
-    for cblock in previous_blocks.values():
-        block_data = json.loads(chain_helper.toJSON(cblock))
-        timestamp = block_data.get("timestamp")
-        if timestamp is not None and block_data.get("index", 0) != 0:
-            nonce_time = timestamp - previous_block_timestamp
-            if nonce_time < MAX_CHANGING_INT:
-                range_timestamps += nonce_time
-            previous_block_timestamp = timestamp
-    
-    if current_block.index % CHANGING_DIFF_TIME == 0:
+    def remove(self, blockHashes, blocks: Dict[str, block.Block]) -> None:
+        """
+        Forgets removed blocks. blocks is what the chain has left, in the
+        order it added them.
+        """
+        removed = set(blockHashes)
+        positions = [i for i, entry in enumerate(self.recent) if entry[0] in removed]
+        if len(positions) < len(removed):
+            self.rebuild(blocks.values())
+            return
+        if not positions:
+            return
+
+        entries = list(self.recent)
+        self.recent = deque(entries[:positions[0]])
+        for blockHash, index, timestamp, *_ in entries[positions[0]:]:
+            if blockHash not in removed:
+                self._append(blockHash, index, timestamp)
+        self.count -= len(removed)
+
+    def getUpdateDiff(self, previous_block_diff: int) -> int:
+        """
+        The retarget difficulty over every tracked block.
+        """
+        range_count = self.count
+        range_timestamps = self._sums()[0]
         average_block_mine = range_timestamps / range_count if range_count else BLOCK_TIME
         minus_diff = average_block_mine / BLOCK_TIME
         return int(MIN_MINING_DIFFICULTY + (previous_block_diff * MAX_CHANGING_DIFF) - (MAX_CHANGING_DIFF * minus_diff))
 
 
+def blockWork(difficulty: int) -> int:
+    """
+    The expected number of hashes needed to mine a block at the difficulty
+    it had to meet: 16 to the power of it.
+    """
+    return 16 ** difficulty
+
 
 class Chain:
     def __init__(
-            self, persistentFilename=None) -> None:
+            self,
+            persistentFilename=None,
+            utxo: UTXOManager = None,
+            undo=None,
+            reorgLimit: int = MAX_REORG_DEPTH,
+            verifier=None) -> None:
         # Blocks is a mapping from block hash to block objects
         self.blocks: Dict[str, block.Block] = {}
 
-        # UTXO is a mapping from transaction hash to transaction objects
-        self.utxo = UTXOManager()
+        # The total work of the chain ending in each block.
+        self.chainWork: Dict[str, int] = {}
+
+        # The hashes of the blocks at every height that may still have
+        # side branches. Heights more than reorgLimit below the head only
+        # keep their main chain block and are dropped from here.
+        self.heights: Dict[int, List[str]] = {}
+        self.reorgLimit = reorgLimit
+
+        # The set of unspent outputs of the main chain. An empty manager
+        # with a persistent backend can be passed in to keep it on disk.
+        self.utxo = utxo if utxo is not None else UTXOManager()
+
+        # The outputs every main chain block spent, used to disconnect it.
+        self.undo = undo if undo is not None else MemoryUndoStore()
+
+        # An executor, such as a process pool, that verifies the signatures
+        # of a block in parallel before it is connected. Without one they
+        # are verified one by one while connecting.
+        self.verifier = verifier
 
-        # The head should always point to the longest and
-        # oldest chain.
+        # Hashes of blocks assumed to be valid, whose signatures are not
+        # checked when they are connected. Everything else is still checked.
+        self.assumeValid: Set[str] = set()
+
+        # The head should always point to the chain with the most work,
+        # the oldest one if there is a tie.
         self.head = block.genesisBlock()
         self.blocks[self.head.hash] = self.head
+        self.chainWork[self.head.hash] = 0
+
+
+        # Running difficulty sums over self.blocks, in the same order.
+        self.difficulty = DifficultyTracker()
+        self.difficulty.add(self.head)
+        self.heights[self.head.index] = [self.head.hash]
+
+        # The hashes of the main chain blocks, indexed by height.
+        self.mainChain: List[str] = [self.head.hash]
+
+        self._connectBlock(self.head)
+        self.utxo.flush(self.head.hash)
+
+        # Listeners are told about every block that joins or leaves
+        # the main chain.
+        self.listeners: List[object] = []
+
+    def addListener(self, listener) -> None:
+        """
+        Registers an object with blockConnected(block) and
+        blockDisconnected(block) methods. The blocks that are already in the
+        main chain are connected to it right away, oldest first.
+        """
+        self.listeners.append(listener)
+
+        for blockHash in self.mainChain:
+            listener.blockConnected(self.blocks[blockHash])
 
-        for tx in self.head.transactions:
-            self.utxo.spend(tx)
+    def loadSnapshot(
+            self,
+            mainChain: List[block.Block],
+            utxo: UTXOManager) -> None:
+        """
+        Replaces the main chain with already validated blocks and the UTXO
+        set at their tip, without verifying them again. The list runs from
+        the genesis block to the tip. This is still linear in the chain
+        length, every block is added and passed to the listeners.
+        """
+        if mainChain[0].hash != self.head.hash:
+            raise ChainException("Snapshot does not start at the genesis block.")
+
+        for mainBlock in mainChain[1:]:
+            difficulty = self.getNextDifficulty(self.blocks[mainBlock.previousHash])
+            self.blocks[mainBlock.hash] = mainBlock
+            self.difficulty.add(mainBlock)
+            self.chainWork[mainBlock.hash] = \
+                self.chainWork[mainBlock.previousHash] + blockWork(difficulty)
+            self.heights[mainBlock.index] = [mainBlock.hash]
+        self.head = mainChain[-1]
+        self.mainChain = [mainBlock.hash for mainBlock in mainChain]
+        self._prune()
+        self.utxo = utxo
+        self.utxo.flush(self.head.hash)
+
+        for mainBlock in mainChain[1:]:
+            for listener in self.listeners:
+                listener.blockConnected(mainBlock)
 
     def addBlock(self, nextBlock: block.Block) -> None:
         """
@@ -238,7 +715,12 @@ class Chain:
             raise NoParentException(
                 "New block's previous block is not in the current chain.")
 
-        isVerified, msg = verifyNextBlock(previousBlock, nextBlock, self.blocks)
+        if nextBlock.index <= self.head.index - self.reorgLimit:
+            raise StaleBlockException(
+                "New block forks off deeper than the reorg limit.")
+
+        difficulty = self.getNextDifficulty(previousBlock)
+        isVerified, msg = verifyNextBlock(previousBlock, nextBlock, difficulty)
         if not isVerified:
             raise ChainException(
                 "New block could not be verified." +
@@ -247,32 +729,43 @@ class Chain:
         # Creates a new fork in the chain if the next block's previous block
         # does exist in the current chain.
         self.blocks[nextBlock.hash] = nextBlock
+        self.difficulty.add(nextBlock)
+        self.chainWork[nextBlock.hash] = \
+            self.chainWork[previousBlock.hash] + blockWork(difficulty)
+        self.heights.setdefault(nextBlock.index, []).append(nextBlock.hash)
 
-        if nextBlock.index > self.head.index:
+        if self.chainWork[nextBlock.hash] > self.chainWork[self.head.hash]:
             self._updateUTXOAndHead(nextBlock)
+            self._prune()
 
     def _updateUTXOAndHead(self, nextBlock):
         """
-        Updated the UTXO for a block being added to the end of the chain
-        of the main chain.
+        Updated the UTXO for a block that ends a chain with more work than
+        the main chain.
 
         When a fork becomes the main chain, the UTXO from the current main chain
         are reverted and the new forks outputs are spent.
         """
-        if nextBlock.index != self.head.index + 1:
-            raise ChainException("Block added to block chain index is invalid")
-
         # Handle the fork in the rare case where the forked chain becomes
-        # the main chain.
+        # the main chain. The branches can differ in length, so first walk
+        # the longer one back to the height of the other.
         oldChain: List[block.Block] = []
         newChain: List[block.Block] = []
         newChain.append(nextBlock)
 
         oldParent = self.head
         newParent = self.getPreviousBlock(nextBlock)
+        while newParent.index > oldParent.index:
+            newChain.append(newParent)
+            newParent = self.getPreviousBlock(newParent)
+
+        while oldParent.index > newParent.index:
+            self._disconnectBlock(oldParent)
+            oldChain.append(oldParent)
+            oldParent = self.getPreviousBlock(oldParent)
+
         while oldParent.hash != newParent.hash:
-            for tx in reversed(oldParent.transactions):
-                self.utxo.revert(tx)
+            self._disconnectBlock(oldParent)
 
             oldChain.append(oldParent)
             newChain.append(newParent)
@@ -281,12 +774,16 @@ class Chain:
             newParent = self.getPreviousBlock(newParent)
 
         for i in range(len(newChain) - 1, -1, -1):
+            checkSignatures = newChain[i].hash not in self.assumeValid
+            if checkSignatures:
+                self._verifySignatures(newChain[i])
             transactions = newChain[i].transactions
+            spent: List[List[Tuple[bytes, float, str]]] = []
             for j in range(len(transactions)):
                 tx = transactions[j]
-                canSpend, msg = self.utxo.canSpend(tx)
+                canSpend, msg = self.utxo.canSpend(tx, checkSignatures)
                 if canSpend:
-                    self.utxo.spend(tx)
+                    spent.append(self.utxo.spend(tx))
                 else:
                     # An invalid transaction was found. This means that
                     # all the new transactions need to be reverted,
@@ -294,28 +791,145 @@ class Chain:
 
                     # Revert the transactions just added from the current block.
                     for txIndex in range(j - 1, -1, -1):
-                        self.utxo.revert(transactions[txIndex])
+                        self.utxo.revert(transactions[txIndex], spent[txIndex])
 
                     # Revert the transacation from the blocks added earlier.
                     for blockIndex in range(i + 1, len(newChain)):
-                        for tx in reversed(newChain[blockIndex].transactions):
-                            self.utxo.revert(tx)
+                        self._disconnectBlock(newChain[blockIndex])
 
                     # Delete the children blocks from the invalid block
                     # as well as the :nvalid block itself from the chain.
                     for k in range(i, -1, -1):
-                        del self.blocks[newChain[k].hash]
+                        self._removeBlock(newChain[k])
 
                     for oldBlock in reversed(oldChain):
-                        for tx in reversed(oldBlock.transactions):
-                            self.utxo.spend(tx)
+                        self._connectBlock(oldBlock)
 
                     raise UTXOException(msg)
 
+            self.undo.put(
+                newChain[i].hash, [output for txSpent in spent for output in txSpent])
+
         # If the new block increases the length of the current chain, then have
         # head point to this block. The verifyNextBlock method should check
         # that the new index is not out too large.
         self.head = nextBlock
+        self.utxo.flush(self.head.hash)
+        del self.mainChain[oldParent.index + 1:]
+        for i in range(len(newChain) - 1, -1, -1):
+            self.mainChain.append(newChain[i].hash)
+            self._bury(newChain[i].index - self.reorgLimit)
+
+        for oldBlock in oldChain:
+            for listener in self.listeners:
+                listener.blockDisconnected(oldBlock)
+
+        for i in range(len(newChain) - 1, -1, -1):
+            for listener in self.listeners:
+                listener.blockConnected(newChain[i])
+
+    def _verifySignatures(self, newBlock: block.Block) -> None:
+        """
+        Verifies the signatures of a block on the verifier before it is
+        connected. The valid ones go into the signature cache, so canSpend
+        only does the UTXO work; an invalid one is left for canSpend to
+        report. The UTXO set must be at the parent of the block.
+        """
+        if self.verifier is None:
+            return
+
+        # The transactions of the block, whose outputs later ones may spend.
+        created: Dict[str, transaction.Transaction] = {}
+        jobs: List[transaction.Transaction] = []
+        addresses: List[List[str]] = []
+        for tx in newBlock.transactions:
+            created[tx.hash] = tx
+            txAddresses = []
+            for tInput in tx.inputs:
+                index = tInput.referencedOutputIndex
+                parent = created.get(tInput.referencedHash, None)
+                if parent is not None and isinstance(index, int) \
+                        and 0 <= index < len(parent.outputs):
+                    txAddresses.append(parent.outputs[index].address)
+                    continue
+                referenced = self.utxo.getOutput(tInput.referencedHash, index)
+                if referenced is None:
+                    break
+                txAddresses.append(referenced[1])
+
+            if txAddresses and len(txAddresses) == len(tx.inputs) \
+                    and not transaction.signatureCache.hasTransaction(tx, txAddresses):
+                jobs.append(tx)
+                addresses.append(txAddresses)
+
+        if len(jobs) < 2:
+            return
+        results = self.verifier.map(transaction.verifySignatures, jobs, addresses)
+        for tx, txAddresses, (isValid, _) in zip(jobs, addresses, results):
+            if isValid:
+                transaction.signatureCache.addTransaction(tx, txAddresses)
+
+    def _bury(self, height: int) -> None:
+        """
+        Drops the cached signatures of the main chain block at a height that
+        can no longer be reorganized, its transactions are not verified
+        again.
+        """
+        if height < 1:
+            return
+        for tx in self.blocks[self.mainChain[height]].transactions:
+            transaction.signatureCache.evictTransaction(tx)
+
+    def _removeBlock(self, oldBlock: block.Block) -> None:
+        del self.blocks[oldBlock.hash]
+        self.difficulty.remove([oldBlock.hash], self.blocks)
+        del self.chainWork[oldBlock.hash]
+        hashes = self.heights.get(oldBlock.index, [])
+        if oldBlock.hash in hashes:
+            hashes.remove(oldBlock.hash)
+
+    def _prune(self) -> None:
+        """
+        Drops the side branch blocks at heights more than reorgLimit below
+        the head. No block can be added at those heights anymore, so the
+        main chain block is all that is left to keep track of.
+        """
+        horizon = self.head.index - self.reorgLimit
+        if horizon < 0 or min(self.heights) > horizon:
+            return
+
+        mainBlock = self.blocks[self.mainChain[horizon]]
+        pruned: Set[str] = set()
+        while mainBlock is not None and mainBlock.index in self.heights:
+            for blockHash in self.heights.pop(mainBlock.index):
+                if blockHash != mainBlock.hash:
+                    pruned.add(blockHash)
+            mainBlock = self.getPreviousBlock(mainBlock)
+
+        # Blocks above the horizon that build on a pruned block go as well.
+        if not pruned:
+            return
+        for height in sorted(self.heights):
+            for blockHash in self.heights[height]:
+                if self.blocks[blockHash].previousHash in pruned:
+                    pruned.add(blockHash)
+            self.heights[height] = [
+                blockHash for blockHash in self.heights[height]
+                if blockHash not in pruned]
+
+        for blockHash in pruned:
+            del self.blocks[blockHash]
+            del self.chainWork[blockHash]
+        self.difficulty.remove(pruned, self.blocks)
+
+    def _connectBlock(self, newBlock: block.Block) -> None:
+        self.undo.put(newBlock.hash, self.utxo.connectBlock(newBlock))
+
+    def _disconnectBlock(self, oldBlock: block.Block) -> None:
+        undo = self.undo.get(oldBlock.hash)
+        if undo is None:
+            raise UTXOException("Undo record of the block does not exist.")
+        self.utxo.disconnectBlock(oldBlock, undo)
 
     def addBlocks(self, newBlocks: List[block.Block]) -> None:
         """
@@ -347,15 +961,8 @@ class Chain:
         if parent.index < 0:
             raise ChainException("Parent index is negative.")
 
-        children: List[block.Block]
-        children = []
-        child = self.head
-        while child.index > 0 and parent.hash != child.hash:
-            children.append(child)
-            child = self.getPreviousBlock(child)
-
-        children.reverse()
-        return children
+        start = parent.index + 1 if self.isMainChain(parent) else 1
+        return [self.blocks[blockHash] for blockHash in self.mainChain[start:]]
 
     def getAncestors(self, child: block.Block, n=-1) -> List[block.Block]:
         """
@@ -369,7 +976,8 @@ class Chain:
         if n == 0:
             return longestChain
 
-        while n != 0 and child.index > 0:
+        # Walk a side branch back to the main chain, the rest is a slice.
+        while n != 0 and child.index > 0 and not self.isMainChain(child):
             longestChain.append(child)
 
             child = self.getPreviousBlock(child)
@@ -378,8 +986,35 @@ class Chain:
                     "Ancestors of block do not exist in chain")
             n -= 1
 
+        if n != 0 and child.index > 0:
+            lowest = 1 if n < 0 else max(1, child.index - n + 1)
+            for blockHash in reversed(self.mainChain[lowest:child.index + 1]):
+                longestChain.append(self.blocks[blockHash])
+
         return longestChain
 
+    def getNextDifficulty(self, previousBlock: block.Block) -> int:
+        """
+        The difficulty verifyNextBlock requires from a block mined on top of
+        previousBlock.
+        """
+        previousDiff = checkProofOfWork(previousBlock.hash)
+        if (previousBlock.index + 1) % CHANGING_DIFF_TIME != 0:
+            return previousDiff
+        return self.difficulty.getUpdateDiff(previousDiff)
+
+    def isMainChain(self, mainBlock: block.Block) -> bool:
+        return 0 <= mainBlock.index < len(self.mainChain) \
+            and self.mainChain[mainBlock.index] == mainBlock.hash
+
+    def getMainChainHashes(self, offset: int, limit: int) -> List[str]:
+        """
+        Returns the hashes of the main chain blocks at heights offset up to
+        offset + limit, oldest first.
+        """
+        offset = max(offset, 0)
+        return self.mainChain[offset:offset + max(limit, 0)]
+
     def getPreviousBlock(self, currentBlock: block.Block) -> block.Block:
         """
         Returns the previous block if it is in the chain
@@ -391,20 +1026,25 @@ class Chain:
         return None
 
     def getTransaction(self, transaction_hash: str):
+        """
+        Scans every block for the transaction. Nodes should look transactions
+        up through their transaction index instead.
+        """
         for transaction_block in self.blocks.values():
-            for data in json.loads(transaction_block.toJSON())["transactions"]:
-                if data["hash"] == transaction_hash:
-                    return json.dumps(data, indent=2)
+            for tx in transaction_block.transactions:
+                if tx.hash == transaction_hash:
+                    return json.dumps(tx.asDict(), indent=2)
 
 
 def verifyNextBlock(
         previousBlock: block.Block,
         nextBlock: block.Block,
-        previous_blocks: Dict[str, block.Block]) -> Tuple[bool, str]:
+        difficulty: int) -> Tuple[bool, str]:
     """
     Verifies whether a block can syntactically can be added to the chain.
     Once a block is added to the chain with this method called, the only
-    remaining check is the "canSpend" method in the UTXO.
+    remaining check is the "canSpend" method in the UTXO. The difficulty
+    is the one Chain.getNextDifficulty requires on top of previousBlock.
     """
 
     if nextBlock.index != previousBlock.index + 1:
@@ -426,14 +1066,8 @@ def verifyNextBlock(
         return False, "Invalid block hash. Current {}, Expected {}".format(
             nextBlock.hash, nextHash)
 
-    if nextBlock.index % CHANGING_DIFF_TIME != 0:
-        previousDiff = checkProofOfWork(nextBlock.previousHash)
-        if not hasProofOfWork(nextBlock.hash, previousDiff):
-            return False, f"Block does not have a valid proof of work. Current diff: {previousDiff}"
-    elif nextBlock.index % CHANGING_DIFF_TIME == 0:
-        currentDiff = update_difficulty(nextBlock, previous_blocks)
-        if not hasProofOfWork(nextBlock.hash, currentDiff):
-            return False, f"Block does not have a valid proof of work. Current diff: {currentDiff}"
+    if not hasProofOfWork(nextBlock.hash, difficulty):
+        return False, f"Block does not have a valid proof of work. Current diff: {difficulty}"
 
     # test max block count
     # print(int(MAX_SUPPLY / COINBASE_REWARD))
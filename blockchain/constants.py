@@ -12,3 +12,4 @@ MAX_BLOCK_COUNT = int(MAX_SUPPLY / COINBASE_REWARD)  # max block count with the
 MAX_CHANGING_DIFF = 5  # multiplier and max number to change the diff
 MAX_CHANGING_INT = 100  # max time that can rewrite the difficulty
 CHANGING_DIFF_TIME = 180  # 3 hours - BLOCK_TIME * CHANDGING_DIFF_TIME
+MAX_REORG_DEPTH = 100  # side branches forking deeper than this below the tip are pruned
@@ -1,5 +1,9 @@
+import hashlib
+import itertools
+import multiprocessing
 import time
-from typing import List
+from functools import lru_cache
+from typing import List, Tuple
 
 import sys, os
 
@@ -10,8 +14,52 @@ from block import Block, hashBlock
 from transaction import Transaction
 from constants import MIN_MINING_DIFFICULTY, CHANGING_DIFF_TIME
 
+# Nonces a mining worker takes from the shared counter at a time.
+NONCE_CHUNK_SIZE = 4096
+
+
+def _hashDigest(hash: str) -> bytes:
+    """
+    Returns the 32 raw bytes of a hex block hash, or None if it is not one.
+    """
+    if len(hash) != 64:
+        return None
+    try:
+        digest = bytes.fromhex(hash)
+    except ValueError:
+        return None
+    return digest if len(digest) == 32 else None
+
+
+def leadingZeroNibbles(digest: bytes) -> int:
+    """
+    Counts the zero half-bytes at the start of a 32 byte digest.
+    """
+    return (256 - int.from_bytes(digest, 'big').bit_length()) // 4
+
+
+@lru_cache(maxsize=None)
+def proofOfWorkTarget(diff: int) -> bytes:
+    """
+    The 32 byte target a digest must be below to start with diff zero
+    half-bytes. Only defined for diff > 0.
+    """
+    return (1 << (256 - 4 * min(diff, 64))).to_bytes(32, 'big')
+
+
+def hasProofOfWorkDigest(digest: bytes, diff: int) -> bool:
+    return digest < proofOfWorkTarget(diff)
+
 
 def checkProofOfWork(hash: str) -> int:
+    digest = _hashDigest(hash)
+    if digest is not None:
+        # Same as the loop below: the number of leading zero half-bytes,
+        # starting the count at MIN_MINING_DIFFICULTY.
+        zeros = leadingZeroNibbles(digest)
+        difficulty = zeros + 1 if zeros >= int(MIN_MINING_DIFFICULTY) else int(MIN_MINING_DIFFICULTY)
+        return difficulty - 1 if difficulty - 1 != 0 else int(MIN_MINING_DIFFICULTY)
+
     difficulty = int(MIN_MINING_DIFFICULTY)
     while True:
         if int(hash[:difficulty], 16) == 0:
@@ -29,47 +77,73 @@ def hasProofOfWork(hash: str, diff: int) -> bool:
     Checks if the first n half-bytes in the hash are zero, where n
     is the difficulty.
     """
+    if diff > 0:
+        digest = _hashDigest(hash)
+        if digest is not None:
+            return hasProofOfWorkDigest(digest, diff)
     difficulty = diff  # Number of most significant bytes that are zero.
     return int(hash[:difficulty], 16) == 0
 
 
+class BlockHasher:
+    """
+    Hashes one block for many nonces. hashBlock serializes the index, the
+    timestamp, the transaction hashes and then the nonce, so everything but
+    the nonce is hashed once up front and every attempt continues from a
+    copy of that state. hash() equals hashBlock for the same block.
+    """
+
+    def __init__(self, index: int, timestamp: float, transactions: List[Transaction]) -> None:
+        combinedTransaction = "".join([transaction.hash for transaction in transactions])
+        self.midstate = hashlib.sha256(
+            "{}{}{}".format(index, timestamp, combinedTransaction).encode('utf-8'))
+
+    def hash(self, noonce: int) -> str:
+        state = self.midstate.copy()
+        state.update(str(noonce).encode('utf-8'))
+        return state.hexdigest()
+
+    def search(self, start: int, stop: int, diff: int) -> int:
+        """
+        Tests the nonces from start up to stop, or without end if stop is
+        None, and returns the first one with a proof of work, or None.
+        """
+        noonces = itertools.count(start) if stop is None else range(start, stop)
+        if diff <= 0:
+            for noonce in noonces:
+                if hasProofOfWork(self.hash(noonce), diff):
+                    return noonce
+            return None
+
+        midstate = self.midstate
+        target = proofOfWorkTarget(diff)
+        for noonce in noonces:
+            state = midstate.copy()
+            state.update(str(noonce).encode('utf-8'))
+            if state.digest() < target:
+                return noonce
+        return None
+
+
 def SimpleGenerateNextBlock(nextIndex, previous_hash, transactions: List[Transaction], currentDiff: int) -> Block:
     nextTimestamp = time.time()
-    noonce = 0
+    hasher = BlockHasher(nextIndex, nextTimestamp, transactions)
     if nextIndex % CHANGING_DIFF_TIME != 0:
-        while True:
-            hash = hashBlock(
-                nextIndex,
-                nextTimestamp,
-                transactions,
-                noonce,
-                previous_hash)
-            if hasProofOfWork(hash, currentDiff):
-                return Block(
-                    index=nextIndex,
-                    timestamp=nextTimestamp,
-                    transactions=transactions,
-                    noonce=noonce,
-                    previousHash=previous_hash)
-            noonce += 1
-        return None
+        noonce = hasher.search(0, None, currentDiff)
+        return Block(
+            index=nextIndex,
+            timestamp=nextTimestamp,
+            transactions=transactions,
+            noonce=noonce,
+            previousHash=previous_hash)
     elif nextIndex % CHANGING_DIFF_TIME == 0:
-        while True:
-            hash = hashBlock(
-                nextIndex,
-                nextTimestamp,
-                transactions,
-                noonce,
-                previous_hash)
-            if hasProofOfWork(hash, currentDiff):
-                return Block(
-                    index=nextIndex,
-                    timestamp=nextTimestamp,
-                    transactions=transactions,
-                    noonce=noonce,
-                    previousHash=previous_hash)
-            noonce += 1
-        return None
+        noonce = hasher.search(0, None, currentDiff)
+        return Block(
+            index=nextIndex,
+            timestamp=nextTimestamp,
+            transactions=transactions,
+            noonce=noonce,
+            previousHash=previous_hash)
 
 
 def generateNextBlock(
@@ -82,41 +156,103 @@ def generateNextBlock(
     previousDiff = checkProofOfWork(previousBlock.hash)
     nextIndex = previousBlock.index + 1
     nextTimestamp = time.time()
-    noonce = 0
+    hasher = BlockHasher(nextIndex, nextTimestamp, transactions)
 
     if nextIndex % CHANGING_DIFF_TIME != 0:
-        while True:
-            hash = hashBlock(
-                nextIndex,
-                nextTimestamp,
-                transactions,
-                noonce,
-                previousBlock.hash)
-            if hasProofOfWork(hash, previousDiff):
-                return Block(
-                    index=nextIndex,
-                    timestamp=nextTimestamp,
-                    transactions=transactions,
-                    noonce=noonce,
-                    previousHash=previousBlock.hash)
-            noonce += 1
-        return None
+        noonce = hasher.search(0, None, previousDiff)
+        return Block(
+            index=nextIndex,
+            timestamp=nextTimestamp,
+            transactions=transactions,
+            noonce=noonce,
+            previousHash=previousBlock.hash)
 
     elif nextIndex % CHANGING_DIFF_TIME == 0:
-        while True:
-            hash = hashBlock(
-                nextIndex,
-                nextTimestamp,
-                transactions,
-                noonce,
-                previousBlock.hash)
-            if hasProofOfWork(hash, currentDiff):
-                return Block(
-                    index=nextIndex,
-                    timestamp=nextTimestamp,
-                    transactions=transactions,
-                    noonce=noonce,
-                    previousHash=previousBlock.hash)
-            noonce += 1
+        noonce = hasher.search(0, None, currentDiff)
+        return Block(
+            index=nextIndex,
+            timestamp=nextTimestamp,
+            transactions=transactions,
+            noonce=noonce,
+            previousHash=previousBlock.hash)
 
-        return None
+
+def _nonceWorker(
+        worker: int,
+        nextIndex: int,
+        timestamp: float,
+        transactions: List[Transaction],
+        previousHash: str,
+        currentDiff: int,
+        counter,
+        best,
+        hashes) -> None:
+    """
+    Searches chunks of nonces taken from the shared counter until the chunk
+    starts above the best solution found so far.
+    """
+    hasher = BlockHasher(nextIndex, timestamp, transactions)
+    while True:
+        with counter.get_lock():
+            start = counter.value
+            counter.value += NONCE_CHUNK_SIZE
+        if 0 <= best.value < start:
+            return
+
+        noonce = hasher.search(start, start + NONCE_CHUNK_SIZE, currentDiff)
+        if noonce is not None:
+            with best.get_lock():
+                if best.value < 0 or noonce < best.value:
+                    best.value = noonce
+            hashes[worker] += noonce - start + 1
+            return
+        hashes[worker] += NONCE_CHUNK_SIZE
+
+
+def ParallelGenerateNextBlock(
+        nextIndex,
+        previous_hash,
+        transactions: List[Transaction],
+        currentDiff: int,
+        workers: int,
+        minTimestamp: float = 0) -> Tuple[Block, List[int], float]:
+    """
+    Mines the same block as SimpleGenerateNextBlock on several processes.
+    Workers take chunks of nonces from a shared counter in increasing
+    order. Once a solution is found, the workers whose chunk starts above it
+    stop, and the ones below it finish their chunks, so the smallest nonce
+    wins just like in the single loop.
+
+    The timestamp is the current time, but not below minTimestamp.
+    Returns the block, the hashes every worker computed and the seconds the
+    search took.
+    """
+    nextTimestamp = max(time.time(), minTimestamp)
+    counter = multiprocessing.Value('q', 0)
+    best = multiprocessing.Value('q', -1)
+    hashes = multiprocessing.Array('q', max(1, workers))
+
+    started = time.time()
+    if workers <= 1:
+        _nonceWorker(0, nextIndex, nextTimestamp, transactions, previous_hash,
+                     currentDiff, counter, best, hashes)
+    else:
+        processes = [
+            multiprocessing.Process(
+                target=_nonceWorker,
+                args=(worker, nextIndex, nextTimestamp, transactions, previous_hash,
+                      currentDiff, counter, best, hashes),
+                daemon=True)
+            for worker in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    elapsed = time.time() - started
+
+    return Block(
+        index=nextIndex,
+        timestamp=nextTimestamp,
+        transactions=transactions,
+        noonce=best.value,
+        previousHash=previous_hash), list(hashes), elapsed
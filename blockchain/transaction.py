@@ -1,3 +1,5 @@
+from collections import OrderedDict
+from functools import lru_cache
 from typing import List, Tuple
 import json
 
@@ -5,6 +7,11 @@ from Cryptodome.Signature import PKCS1_PSS
 from Cryptodome.PublicKey import RSA
 from Cryptodome.Hash import SHA256
 
+# Number of parsed public keys kept by getVerifier.
+VERIFIER_CACHE_SIZE = 4096
+# Number of verified signatures kept by signatureCache.
+SIGNATURE_CACHE_SIZE = 100000
+
 
 class TransactionInput:
     def __init__(
@@ -131,8 +138,6 @@ def verifyTransactionInput(
     is the same person who recieved it as an output.
     """
     newInput = transaction.inputs[inputIndex]
-    serializedOutputs = \
-        TransactionOutput.serializeMultiple(transaction.outputs)
 
     # Check if referenced index is out of bounds
     index = newInput.referencedOutputIndex
@@ -143,18 +148,143 @@ def verifyTransactionInput(
         return False, "Referenced transaction hash does not match."
 
     referencedOutput = referencedTransaction.outputs[index]
-    publicKey = RSA.importKey(bytes.fromhex(referencedOutput.address))
-    verifier = PKCS1_PSS.new(publicKey)
+    return verifyInputSignature(
+        referencedOutput.address, transaction, inputIndex)
+
+
+class SignatureCache:
+    """
+    Remembers the input signatures that verified, so a transaction checked
+    when it entered the mempool is not checked again when its block
+    connects, or when a reorg connects it again.
+
+    Entries are keyed by the signature hash and the signature and hold the
+    address they verified against. The cache keeps at most maxSize entries
+    and drops the least recently used first. The chain evicts the entries
+    of a block once it is buried too deep to be reorganized.
+    """
+
+    def __init__(self, maxSize: int = SIGNATURE_CACHE_SIZE) -> None:
+        self.maxSize = maxSize
+        self.entries: "OrderedDict[Tuple[bytes, str], str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def contains(self, sigHash: bytes, signature: str, address: str) -> bool:
+        key = (sigHash, signature)
+        if self.entries.get(key, None) == address:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, sigHash: bytes, signature: str, address: str) -> None:
+        key = (sigHash, signature)
+        self.entries[key] = address
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def _keys(transaction: Transaction) -> List[Tuple[bytes, str]]:
+        serializedOutputs = TransactionOutput.serializeMultiple(transaction.outputs)
+        return [
+            (TransactionInput.createSignatureHash(
+                tInput.referencedHash,
+                tInput.referencedOutputIndex,
+                serializedOutputs).digest(), tInput.signature)
+            for tInput in transaction.inputs]
+
+    def addTransaction(self, transaction: Transaction, addresses: List[str]) -> None:
+        """
+        Adds the signatures of a transaction that were verified elsewhere,
+        for example in a worker process.
+        """
+        for (sigHash, signature), address in zip(self._keys(transaction), addresses):
+            self.add(sigHash, signature, address)
+
+    def hasTransaction(self, transaction: Transaction, addresses: List[str]) -> bool:
+        """
+        Tells whether every signature of a transaction is cached, without
+        counting hits or touching the LRU order.
+        """
+        return all(
+            self.entries.get(key, None) == address
+            for key, address in zip(self._keys(transaction), addresses))
+
+    def evictTransaction(self, transaction: Transaction) -> None:
+        for key in self._keys(transaction):
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+signatureCache = SignatureCache()
+
+
+@lru_cache(maxsize=VERIFIER_CACHE_SIZE)
+def getVerifier(address: str):
+    """
+    Returns the PKCS1_PSS verifier of an address. The same addresses sign
+    over and over, so the parsed keys are kept in a LRU cache;
+    getVerifier.cache_info() reports its hits and misses.
+    """
+    return PKCS1_PSS.new(RSA.importKey(bytes.fromhex(address)))
+
+
+def verifyInputSignature(
+        address: str,
+        transaction: Transaction,
+        inputIndex: int,
+        serializedOutputs: str = None) -> Tuple[bool, str]:
+    """
+    Checks that a transaction input is signed by the owner of the address
+    of the output it spends. Callers checking several inputs of the same
+    transaction can pass its serialized outputs to build them only once.
+    Signatures found in signatureCache are not verified again. A key or
+    signature that does not decode makes the input invalid.
+    """
+    newInput = transaction.inputs[inputIndex]
+    if serializedOutputs is None:
+        serializedOutputs = \
+            TransactionOutput.serializeMultiple(transaction.outputs)
+
     hash = TransactionInput.createSignatureHash(
         newInput.referencedHash,
         newInput.referencedOutputIndex,
         serializedOutputs
     )
-    signature = bytes.fromhex(newInput.signature)
+    sigHash = hash.digest()
+    if signatureCache.contains(sigHash, newInput.signature, address):
+        return True, ""
+
+    try:
+        verifier = getVerifier(address)
+        signature = bytes.fromhex(newInput.signature)
+        if not verifier.verify(hash, signature):
+            return False, "Signature not valid"
+    except (ValueError, TypeError):
+        return False, "Invalid signature"
+
+    signatureCache.add(sigHash, newInput.signature, address)
+    return True, ""
 
-    if not verifier.verify(hash, signature):
-        return False, "Signature not valid"
 
+def verifySignatures(transaction: Transaction, addresses: List[str]) -> Tuple[bool, str]:
+    """
+    Checks the signature of every input against the address of the output
+    it spends. Module level so a process pool can run it.
+    """
+    serializedOutputs = TransactionOutput.serializeMultiple(transaction.outputs)
+    for i, address in enumerate(addresses):
+        isValid, msg = verifyInputSignature(address, transaction, i, serializedOutputs)
+        if not isValid:
+            return False, msg
     return True, ""
 
 
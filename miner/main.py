@@ -1,3 +1,4 @@
+import argparse
 import requests
 import json
 import time
@@ -7,7 +8,6 @@ import os
 # Add the path to the parent directory of 'blockchain'
 sys.path.append(os.path.abspath('../blockchain'))
 import transaction, mine, chain, block
-from chain import get_update_diff
 from constants import *
 from Cryptodome.PublicKey import RSA
 import block as chain_helper
@@ -21,15 +21,6 @@ if os.name == 'nt':
 host_ip = "127.0.0.1"
 host_port = "3006"
 
-# private1 = RSA.generate(2048)
-# address = private1.publickey().exportKey('DER').hex()
-private_key = input("Введите свой ключ\n")
-private1 = RSA.importKey(bytes.fromhex(private_key))
-address = private1.publickey().exportKey('DER').hex()
-# address = input("Введите свой адресс\n")
-
-print(f"Подключена нода {host_ip}:{host_port} ")
-
 
 # address = input("Введите свой адрес")
 # private1 = input("Введите свой приватный ключ (создаст транзакцию если нет транзакций)")
@@ -44,22 +35,23 @@ def get_pending_transactions(ip, port):
         r = requests.get(f"http://{ip}:{port}/get_pending_transactions")
         data = r.text
         j = json.loads(data)
-        pending_data = {}
-        for objects in j["result"]:
-            test_transaction = {
-                "inputs": json.loads(json.dumps(objects))["inputs"],
-                "outputs": json.loads(json.dumps(objects))["outputs"],
-                "timestamp": json.loads(json.dumps(objects))["timestamp"],
-                "hash": json.loads(json.dumps(objects))["hash"]
-            }
-            test_transaction = chain_helper.createFromDictionary(test_transaction)
-            return test_transaction
+        return [transaction.createFromDictionary(objects) for objects in j["result"]]
     except Exception as err:
         print(err)
         time.sleep(1)
         return []
 
 
+def get_work(ip, port):
+    try:
+        r = requests.get(f"http://{ip}:{port}/get_work")
+        j = json.loads(r.text)
+        return j["result"]
+    except Exception as err:
+        print(err)
+        time.sleep(1)
+
+
 def get_blocks(ip, port):
     try:
         full_blocks = []
@@ -109,20 +101,6 @@ def get_last_index(ip, port) -> int:
         print(err)
 
 
-def get_diff(ip, port, block_hash: str):
-    try:
-        last_index = get_last_index(ip, port)
-        json_blocks = get_json_blocks(ip, port)
-        previousDiff = int(mine.checkProofOfWork(block_hash))
-        if last_index + 1 % CHANGING_DIFF_TIME != 0:
-            return previousDiff
-        elif last_index + 1 % CHANGING_DIFF_TIME == 0:
-            currentDiff = (chain.get_update_diff(previousDiff, json_blocks))
-            return currentDiff
-    except Exception as err:
-        print(err)
-
-
 def add_block(ip, port, new_block):
     try:
         r2 = requests.get(f"http://{ip}:{port}/add_block?new_block={new_block}")
@@ -155,6 +133,21 @@ def correctSingleQuoteJSON(s):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="processes searching nonces, every core by default")
+    args = parser.parse_args()
+
+    # Asked here and not at import, so mining processes do not ask again.
+    # private1 = RSA.generate(2048)
+    # address = private1.publickey().exportKey('DER').hex()
+    private_key = input("Введите свой ключ\n")
+    private1 = RSA.importKey(bytes.fromhex(private_key))
+    address = private1.publickey().exportKey('DER').hex()
+    # address = input("Введите свой адресс\n")
+
+    print(f"Подключена нода {host_ip}:{host_port}, процессов: {args.workers}")
+
     pending_transaction_verify = True
     while True:
         # create coinbase transaction
@@ -171,19 +164,22 @@ if __name__ == '__main__':
         all_transactions = [tx1]
         # print(all_transactions)
 
-        last_hash = get_last_hash(host_ip, host_port)
-        diff = get_diff(host_ip, host_port, last_hash)
-        pending_transactions = get_pending_transactions(host_ip, host_port)
-        index = get_last_index(host_ip, host_port)
-        previous_hash = last_hash
+        template = get_work(host_ip, host_port)
+        if template is None:
+            continue
+        diff = template["difficulty"]
+        index = template["index"] - 1
+        previous_hash = template["previous_hash"]
+        pending_transactions = [
+            transaction.createFromDictionary(pending) for pending in template["transactions"]]
 
         # pending_transactions = correctSingleQuoteJSON(pending_transactions)
 
-        if len(str(pending_transactions)) == 0 or pending_transaction_verify is False:
+        if len(pending_transactions) == 0 or pending_transaction_verify is False:
             all_transactions.append(tx2)
         if pending_transaction_verify and pending_transactions:
             print(pending_transactions)
-            all_transactions.append(pending_transactions)
+            all_transactions.extend(pending_transactions)
             '''
             correctJson = correctSingleQuoteJSON(pending_transactions)
             correctJson = correctJson.replace("[", "")
@@ -197,15 +193,20 @@ if __name__ == '__main__':
         print(f"{day_time()} \033[35mНовая задача, \033[0m Сложность {diff}, Блок {index + 1}")
 
         previous_time = time.time()
-        nextBlock = mine.SimpleGenerateNextBlock(index + 1, previous_hash, all_transactions, diff)
+        nextBlock, worker_hashes, seconds = mine.ParallelGenerateNextBlock(
+            index + 1, previous_hash, all_transactions, diff, args.workers,
+            template["min_timestamp"])
         now_time = time.time()
-        if now_time - previous_time != 0:
-            print(f"{day_time()} Хешрейт: {nextBlock.noonce / (now_time - previous_time)} H/s")
+        if seconds != 0:
+            for worker, hashes in enumerate(worker_hashes):
+                print(f"{day_time()} Процесс {worker}: {hashes / seconds} H/s")
+            print(f"{day_time()} Хешрейт: {sum(worker_hashes) / seconds} H/s")
         else:
             print(f"Хешрейт не рассчитан")
         add_result = add_block(host_ip, host_port, nextBlock)
 
         if add_result[0]:
+            pending_transaction_verify = True
             print(
                 f"{day_time()} \033[32mДобыт блок\033[0m {index} при сложности {diff} за {now_time - previous_time} секунд")
         elif not add_result[0]:
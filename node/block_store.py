@@ -0,0 +1,218 @@
+import json
+import os
+import struct
+from typing import Dict, List, Set, Tuple
+
+import sys
+
+# Add the path to the parent directory of 'blockchain'
+sys.path.append(os.path.abspath('../blockchain'))
+sys.path.append(os.path.abspath('../node'))
+import block as chain_helper
+
+SEGMENT_NAME = "blk{:05d}.dat"
+INDEX_NAME = "index.dat"
+
+# height, hash, previous hash, segment, offset, length
+INDEX_RECORD = struct.Struct(">Q32s32sIQI")
+EMPTY_HASH = bytes(32)
+
+
+class BlockStoreException(Exception):
+    pass
+
+
+def _hash_bytes(block_hash: str) -> bytes:
+    """
+    Block hashes are stored as raw 32 bytes. The genesis previous hash is
+    not a hex digest, so anything that does not decode is stored as zeros.
+    """
+    try:
+        raw = bytes.fromhex(block_hash)
+    except ValueError:
+        return EMPTY_HASH
+    return raw if len(raw) == 32 else EMPTY_HASH
+
+
+class BlockStore:
+    """
+    Append-only block storage.
+
+    Serialized blocks are appended to large segment files and an index file
+    maps every (height, hash) to the (segment, offset, length) of the block.
+    The index file is a list of fixed-size records that are appended after
+    the block data is written, so a torn write only loses the last block.
+
+    Reading one block is one seek and one read, appending is one write to
+    the current segment.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 128 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+
+        # hash -> (height, previous hash, segment, offset, length)
+        self.records: Dict[str, Tuple[int, str, int, int, int]] = {}
+        # height -> hashes stored at that height, in append order
+        self.heights: Dict[int, List[str]] = {}
+        # hashes in append order, parents always come before their children
+        self.order: List[str] = []
+
+        self._readers: Dict[int, object] = {}
+        self._writer = None
+        self._segment = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+        self._index_file = open(self._path(INDEX_NAME), "ab")
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _segment_path(self, segment: int) -> str:
+        return self._path(SEGMENT_NAME.format(segment))
+
+    def _load_index(self) -> None:
+        path = self._path(INDEX_NAME)
+        if not os.path.exists(path):
+            return
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        valid = 0
+        segment_sizes: Dict[int, int] = {}
+        for start in range(0, len(data) - INDEX_RECORD.size + 1, INDEX_RECORD.size):
+            height, raw_hash, raw_previous, segment, offset, length = \
+                INDEX_RECORD.unpack_from(data, start)
+
+            if segment not in segment_sizes:
+                segment_path = self._segment_path(segment)
+                segment_sizes[segment] = os.path.getsize(segment_path) \
+                    if os.path.exists(segment_path) else 0
+
+            # The block data never made it to disk, drop the record.
+            if offset + length > segment_sizes[segment]:
+                break
+
+            self._add_record(
+                height, raw_hash.hex(), raw_previous.hex(), segment, offset, length)
+            self._segment = max(self._segment, segment)
+            valid = start + INDEX_RECORD.size
+
+        # Cut off a partially written record so new records stay aligned.
+        if valid != len(data):
+            with open(path, "r+b") as f:
+                f.truncate(valid)
+
+    def _add_record(self, height, block_hash, previous_hash, segment, offset, length) -> None:
+        self.records[block_hash] = (height, previous_hash, segment, offset, length)
+        self.heights.setdefault(height, []).append(block_hash)
+        self.order.append(block_hash)
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __contains__(self, block_hash: str) -> bool:
+        return block_hash in self.records
+
+    def append(self, block: chain_helper.Block) -> None:
+        """
+        Appends a block to the current segment and records it in the index.
+        """
+        if block.hash in self.records:
+            raise BlockStoreException("Block is already stored.")
+
+        data = json.dumps(block.asDict(), separators=(",", ":")).encode("utf-8")
+
+        if self._writer is None:
+            self._writer = open(self._segment_path(self._segment), "ab")
+        offset = self._writer.tell()
+        if offset > 0 and offset + len(data) > self.segment_size:
+            self._writer.close()
+            self._segment += 1
+            self._writer = open(self._segment_path(self._segment), "ab")
+            offset = 0
+
+        self._writer.write(data)
+        self._writer.flush()
+
+        self._index_file.write(INDEX_RECORD.pack(
+            block.index,
+            _hash_bytes(block.hash),
+            _hash_bytes(block.previousHash),
+            self._segment,
+            offset,
+            len(data)))
+        self._index_file.flush()
+
+        self._add_record(
+            block.index, block.hash, _hash_bytes(block.previousHash).hex(),
+            self._segment, offset, len(data))
+
+    def read_raw(self, block_hash: str) -> bytes:
+        """
+        Returns the serialized block with the given hash.
+        """
+        record = self.records.get(block_hash, None)
+        if record is None:
+            raise BlockStoreException("Block is not stored.")
+
+        _, _, segment, offset, length = record
+        reader = self._readers.get(segment, None)
+        if reader is None:
+            reader = open(self._segment_path(segment), "rb")
+            self._readers[segment] = reader
+
+        reader.seek(offset)
+        return reader.read(length)
+
+    def read_dict(self, block_hash: str) -> dict:
+        return json.loads(self.read_raw(block_hash))
+
+    def read(self, block_hash: str) -> chain_helper.Block:
+        return chain_helper.createFromJSON(self.read_raw(block_hash))
+
+    def get_hashes(self, height: int) -> List[str]:
+        return self.heights.get(height, [])
+
+    def get_previous_hash(self, block_hash: str) -> str:
+        return self.records[block_hash][1]
+
+    def get_ancestors(self, block_hash: str) -> Set[str]:
+        """
+        Returns the hashes of a stored block and of its stored ancestors,
+        found through the previous hashes in the index.
+        """
+        ancestors = set()
+        while block_hash in self.records and block_hash not in ancestors:
+            ancestors.add(block_hash)
+            block_hash = self.records[block_hash][1]
+        return ancestors
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+        self._index_file.close()
+
+
+def migrate_legacy_blocks(store: BlockStore, directory: str) -> int:
+    """
+    Copies a directory of block{index}.json files into the block store.
+    Blocks that are already stored are skipped. Returns the number of blocks
+    that were appended.
+    """
+    migrated = 0
+    index = 0
+    while os.path.isfile(os.path.join(directory, f"block{index}.json")):
+        with open(os.path.join(directory, f"block{index}.json"), encoding="utf-8") as f:
+            legacy_block = chain_helper.createFromJSON(f.read())
+        if legacy_block.hash not in store:
+            store.append(legacy_block)
+            migrated += 1
+        index += 1
+    return migrated
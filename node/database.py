@@ -16,66 +16,272 @@ import time
 import ast
 # import AverCoin
 import asyncio
-from settings import pending_transaction_file
+from concurrent.futures import ProcessPoolExecutor
+from settings import pending_transaction_file, legacy_blocks_directory, block_store_directory, block_segment_size
+from settings import utxo_snapshot_interval, utxo_backend, utxo_cache_size, max_reorg_depth
+from block_store import BlockStore, migrate_legacy_blocks
+from tx_index import TransactionIndex
+from utxo_snapshot import read_snapshot, write_snapshot
+from utxo_store import SqliteUTXOBackend, UTXO_DATABASE_NAME
+from undo_store import UndoStore
+from mempool import Mempool
+from settings import mempool_journal, mempool_max_count, mempool_max_bytes, mempool_ttl
+from settings import max_batch_transactions, signature_workers, assume_valid
 
 
 class Database:
-    Chain: dict = None
+    Chain: chain.Chain = None
+    Store: BlockStore = None
+    TxIndex: TransactionIndex = None
+    Undo: UndoStore = None
+    Mempool: Mempool = None
+    Verifier: ProcessPoolExecutor = None
+    # ((tip hash, mempool version), work) of the last get_work call
+    Work: tuple = None
 
     @staticmethod
     def init():
         try:
             print("Database loading...")
-            Chain = chain.Chain()
-            manager = chain.UTXOManager()
-            chain_data = []
-            DIR = os.curdir + '/blocks'
-            files_count = len([name for name in os.listdir(DIR) if os.path.isfile(os.path.join(DIR, name))])
-            if files_count > 0:
-                for i in range(files_count):
-                    chain_data.append(json_helper.read_json(os.getcwd() + f"/blocks/block{i}"))
-                for objects in chain_data:
-                    if objects["index"] != 0:
-                        Chain.addBlock(chain_helper.createFromJSON(chain_helper.toJSON(objects)))
-                print("Database loaded")
+            Database.Chain = Database._load_chain()
+            Database._open_mempool()
+            print("Database loaded")
+        except Exception as err:
+            print(err)
+
+    @staticmethod
+    def _open_verifier():
+        """
+        Opens the process pool that verifies the signatures of blocks and
+        transaction batches.
+        """
+        if Database.Verifier is None:
+            Database.Verifier = ProcessPoolExecutor(signature_workers)
+        return Database.Verifier
+
+    @staticmethod
+    def _open_store():
+        """
+        Opens the block store. An empty store is filled from the legacy
+        blocks directory if there is one.
+        """
+        if Database.Store is None:
+            Database.Store = BlockStore(block_store_directory, block_segment_size)
+            if len(Database.Store) == 0:
+                migrated = migrate_legacy_blocks(Database.Store, legacy_blocks_directory)
+                if migrated > 0:
+                    print(f"Migrated {migrated} blocks from {legacy_blocks_directory}")
+        return Database.Store
+
+    @staticmethod
+    def _open_mempool():
+        """
+        Opens the mempool. Without a journal yet, the transactions of the
+        old pending transactions file are moved into it.
+        """
+        if Database.Mempool is None:
+            migrate = mempool_journal is None or not os.path.exists(mempool_journal)
+            Database.Mempool = Mempool(
+                mempool_journal,
+                Database.import_blocks(),
+                max_count=mempool_max_count,
+                max_bytes=mempool_max_bytes,
+                ttl=mempool_ttl)
+            if migrate and os.path.exists(f"{pending_transaction_file}.json"):
+                for pending in Database.import_pending_transactions(pending_transaction_file):
+                    Database.Mempool.add(transaction.createFromDictionary(pending))
+            # Replaying the chain drops transactions that were mined while
+            # the node was down.
+            Database.import_blocks().addListener(Database.Mempool)
+        return Database.Mempool
+
+    @staticmethod
+    def _load_chain():
+        """
+        Restores the chain from the last UTXO snapshot and replays the stored
+        blocks after it. This is only done once at startup, after that the
+        resident chain is advanced block by block in add_block.
+        """
+        if Database.Undo is None:
+            Database.Undo = UndoStore(block_store_directory)
+        Chain = chain.Chain(
+            undo=Database.Undo,
+            reorgLimit=max_reorg_depth,
+            verifier=Database._open_verifier())
+        store = Database._open_store()
+        if Database.TxIndex is None:
+            Database.TxIndex = TransactionIndex(block_store_directory)
+        Chain.addListener(Database.TxIndex)
+        if len(store) == 0:
+            store.append(Chain.head)
+
+        if utxo_backend == "sqlite":
+            Database._load_utxo_store(Chain, store)
+        else:
+            Database._load_snapshot(Chain, store)
+
+        # A stored block on a stale fork must not vouch for its ancestors.
+        if assume_valid is not None:
+            if assume_valid in Chain.blocks and Chain.isMainChain(Chain.blocks[assume_valid]):
+                Chain.assumeValid = store.get_ancestors(assume_valid)
             else:
-                blocks_count = 0
-                for block in Chain.blocks:
-                    f = open(f'{DIR}/block{blocks_count}.json', 'x')
-                    f.write(str(Chain.blocks[block]))
-                    f.close()
-                    blocks_count += 1
+                print(f"Block {assume_valid} is not on the main chain, checking every signature")
+
+        for block_hash in store.order:
+            if block_hash in Chain.blocks:
+                continue
+            stored_block = store.read(block_hash)
+            if stored_block.index == 0:
+                continue
+            try:
+                Chain.addBlock(stored_block)
+            except chain.StaleBlockException:
+                # Old side branches stay on disk but are not loaded.
+                continue
+            except chain.ChainException as err:
+                # Side branches are stored before their transactions are
+                # checked, so an invalid one is skipped instead of failing.
+                print(err)
+
+        # Blocks that arrive later are checked in full.
+        Chain.assumeValid = set()
+        return Chain
 
+    @staticmethod
+    def _load_snapshot(Chain, store):
+        """
+        Puts the main chain up to the snapshot tip into the chain without
+        verifying it again. Without a usable snapshot nothing is loaded and
+        the whole chain gets replayed.
+
+        The snapshot saves the signature checks and the UTXO replay only.
+        The chain keeps every block in memory, so each one is still read
+        from the store, parsed and passed to the listeners.
+        """
+        try:
+            snapshot = read_snapshot(block_store_directory)
+            if snapshot is None:
+                return
+            tip, height, utxo = snapshot
+
+            main_chain = Database._read_main_chain(store, tip)
+            if len(main_chain) != height + 1:
+                print("UTXO snapshot does not match the block store")
+                return
+            Chain.loadSnapshot(main_chain, utxo)
+            print(f"UTXO snapshot loaded at block {height}")
         except Exception as err:
             print(err)
 
+    @staticmethod
+    def _load_utxo_store(Chain, store):
+        """
+        Switches the chain to the on-disk UTXO set. The set is only trusted
+        if the block it was last flushed at is stored, otherwise it is
+        cleared and rebuilt by replaying the blocks.
+        """
+        backend = SqliteUTXOBackend(
+            os.path.join(block_store_directory, UTXO_DATABASE_NAME), utxo_cache_size)
+        utxo = chain.UTXOManager(backend)
+
+        main_chain = []
+        best_block = backend.bestBlock()
+        if best_block is not None:
+            main_chain = Database._read_main_chain(store, best_block)
+        if len(main_chain) == 0 or main_chain[0].hash != Chain.head.hash:
+            if best_block is not None:
+                print("UTXO database does not match the block store, rebuilding it")
+            backend.clear()
+            main_chain = [Chain.head]
+            utxo.connectBlock(Chain.head)
+
+        Chain.loadSnapshot(main_chain, utxo)
+        print(f"UTXO database loaded at block {Chain.head.index}")
+
+    @staticmethod
+    def _read_main_chain(store, tip):
+        """
+        Reads the stored blocks from the genesis block up to the tip.
+        """
+        main_chain = []
+        block_hash = tip
+        while block_hash in store:
+            main_chain.append(store.read(block_hash))
+            block_hash = store.get_previous_hash(block_hash)
+        main_chain.reverse()
+        return main_chain
+
+    @staticmethod
+    def write_snapshot():
+        try:
+            write_snapshot(block_store_directory, Database.import_blocks())
+        except Exception as err:
+            print(err)
+
+    @staticmethod
+    def close():
+        """
+        Writes a final snapshot on a clean shutdown. The on-disk UTXO set
+        is already flushed at every block and only needs to be closed.
+        """
+        if Database.Chain is None:
+            return
+        if utxo_backend == "sqlite":
+            Database.Chain.utxo.backend.close()
+        else:
+            Database.write_snapshot()
+        Database.Store.close()
+        Database.TxIndex.close()
+        Database.Undo.close()
+        if Database.Mempool is not None:
+            Database.Mempool.close()
+        if Database.Verifier is not None:
+            Database.Verifier.shutdown()
+
     @staticmethod
     def import_blocks():
+        """
+        Returns the resident chain, loading it first if init was not called.
+        """
         try:
-            Chain = chain.Chain()
-            manager = chain.UTXOManager()
-            chain_data = []
-            DIR = os.curdir + '/blocks'
-            files_count = len([name for name in os.listdir(DIR) if os.path.isfile(os.path.join(DIR, name))])
-            if files_count > 0:
-                for i in range(files_count):
-                    chain_data.append(json_helper.read_json(os.getcwd() + f"/blocks/block{i}"))
-                for objects in chain_data:
-                    if objects["index"] != 0:
-                        Chain.addBlock(chain_helper.createFromJSON(chain_helper.toJSON(objects)))
-                return Chain
-            else:
-                blocks_count = 0
-                for block in Chain.blocks:
-                    f = open(f'{DIR}/block{blocks_count}.json', 'x')
-                    f.write(str(Chain.blocks[block]))
-                    f.close()
-                    blocks_count += 1
+            if Database.Chain is None:
+                Database.Chain = Database._load_chain()
+            return Database.Chain
 
         except Exception as err:
             print(err)
             return None
 
+    @staticmethod
+    def reindex():
+        """
+        Rebuilds the transaction index from the main chain.
+        """
+        Chain = Database.import_blocks()
+        Chain.listeners.remove(Database.TxIndex)
+        Database.TxIndex.reset()
+        Chain.addListener(Database.TxIndex)
+
+    @staticmethod
+    def get_last_hash():
+        return Database.import_blocks().head.hash
+
+    @staticmethod
+    def get_last_index():
+        return Database.import_blocks().head.index
+
+    @staticmethod
+    def get_balance(address: str):
+        return Database.import_blocks().utxo.getBalance(address)
+
+    @staticmethod
+    def get_utxos(address: str, offset: int, limit: int):
+        utxo = Database.import_blocks().utxo
+        outputs = []
+        for tx_hash, output_index, amount in utxo.getAddressOutputs(address, offset, limit):
+            outputs.append({"hash": tx_hash, "index": output_index, "amount": amount})
+        return {"total": utxo.getAddressCount(address), "outputs": outputs}
+
     @staticmethod
     def import_pending_transactions(file):
         json_data = json.dumps(list(json_helper.read_json(file)["Pending_transactions"]))
@@ -85,97 +291,101 @@ class Database:
     def get_difficulty(block_hash: str):
         try:
             Chain = Database.import_blocks()
-            previousDiff = int(mine.checkProofOfWork(str(Chain.blocks[block_hash].hash)))
-            if len(Chain.blocks)+1 % CHANGING_DIFF_TIME != 0:
-                return previousDiff
-            elif len(Chain.blocks)+1 % CHANGING_DIFF_TIME == 0:
-                currentDiff = (chain.get_update_diff(previousDiff, Chain.blocks))
-                return currentDiff
+            return Chain.getNextDifficulty(Chain.blocks[block_hash])
         except Exception as err:
             print(err)
 
 
     @staticmethod
     def add_block(block: chain_helper.Block):
-        remove_pending = False
         try:
-            pending_transactions = Database.import_pending_transactions(pending_transaction_file)
-            for objects in pending_transactions:
-                d = objects["hash"]
-                for block_transactions in block.transactions:
-                    b_hash = json.loads(chain_helper.toJSON(block_transactions))["hash"]
-                    if str(d) == str(b_hash):
-                        remove_pending = True
-                        # print(remove_pending)
-                    # else:
-                    # print("transactions != pending_transactions")
-                    # print("d", d)
-                    # print("b_hash", b_hash)
-            if remove_pending:
-                Database.clear_pending_transactions(pending_transaction_file)
-
+            # The mempool follows the chain as a listener and drops the
+            # transactions the block includes.
+            Database._open_mempool()
             Chain = Database.import_blocks()
             Chain.addBlock(block)
-            DIR = os.curdir + '/blocks'
-            f = open(f'{DIR}/block{block.index}.json', 'x')
-            f.write(str(Chain.blocks[block.hash]))
-            f.close()
+            Database._open_store().append(block)
+            if utxo_backend != "sqlite" and Chain.head.hash == block.hash \
+                    and block.index % utxo_snapshot_interval == 0:
+                Database.write_snapshot()
             return True
         except Exception as err:
             print(err)
             return False
 
     @staticmethod
-    def add_pending_transactions(file, pending_transaction: str):
-        pending_transactions = json.load(open(f'{file}.json'))
-        pending_transaction = json.loads(pending_transaction)
-        if not pending_transaction["inputs"]:
-            return False, "Coinbase transaction don't needed in pending"
-        pending_data = {
-            "Pending_transactions": [
-                {
-                    "inputs": pending_transaction["inputs"],
-                    "outputs": pending_transaction["outputs"],
-                    "timestamp": pending_transaction["timestamp"],
-                    "hash": pending_transaction["hash"]
-                },
-            ],
+    def get_block_template():
+        """
+        Everything a miner needs for the next block: its index, the previous
+        hash, the required difficulty and the pending transactions to put
+        in it. One slot is left for the coinbase transaction.
+        """
+        Chain = Database.import_blocks()
+        transactions = Database._open_mempool().select(MAX_TRANSACTIONS_PER_BLOCK - 1)
+        return {
+            "index": Chain.head.index + 1,
+            "previous_hash": Chain.head.hash,
+            "difficulty": Chain.getNextDifficulty(Chain.head),
+            "transactions": [tx.asDict() for tx in transactions],
         }
-        json_data = json.dumps(list(json_helper.read_json(file)["Pending_transactions"]))
-        if len(json.loads(json_data)) + 1 > MAX_TRANSACTIONS_PER_BLOCK:
-            return False, "Transactions are full"
-        for objects in json.loads(json_data):
-            pending_data["Pending_transactions"].append({
-                "inputs": json.loads(json.dumps(objects))["inputs"],
-                "outputs": json.loads(json.dumps(objects))["outputs"],
-                "timestamp": json.loads(json.dumps(objects))["timestamp"],
-                "hash": json.loads(json.dumps(objects))["hash"]
-            })
-            if json.loads(json.dumps(objects))["hash"] == pending_transaction["hash"]:
-                return False, "Transaction already in the block"
-
-        verify_data = transaction.createFromDictionary(pending_transaction)
-        pending_transactions.update(pending_data)
-        print(chain.verifyTransactionSyntax([verify_data]))
-        if chain.verifyTransactionSyntax([verify_data]):
-            json.dump(pending_transactions, open(f'{file}.json', 'w'), indent=2)
-        else:
-            return False, "Transaction is bad"
-        return True, "Transaction added"
 
     @staticmethod
-    def clear_pending_transactions(file):
-        with open(f"{file}.json", encoding="utf8") as f:
-            dict_ = json.load(f)
+    def get_work():
+        """
+        The block template plus the lowest timestamp the next block should
+        have. The template is built once per tip and mempool state, so miners
+        polling between blocks get the cached answer. The difficulty is read
+        from the chain on every call.
+        """
+        Chain = Database.import_blocks()
+        key = (Chain.head.hash, Database._open_mempool().version)
+        if Database.Work is None or Database.Work[0] != key:
+            work = Database.get_block_template()
+            work["min_timestamp"] = Chain.head.timestamp
+            Database.Work = (key, work)
+        return dict(Database.Work[1], difficulty=Chain.getNextDifficulty(Chain.head))
 
-        pop_count = 0
-        for objects in dict_["Pending_transactions"]:
-            pop_count += 1
-        for i in range(pop_count):
-            dict_["Pending_transactions"].pop()
+    @staticmethod
+    def add_pending_transactions(pending_transaction: str):
+        mempool = Database._open_mempool()
+        verify_data = transaction.createFromDictionary(json.loads(pending_transaction))
+        return mempool.add(verify_data)
 
-        with open(f"{file}.json", "w", encoding="utf8") as f:
-            json.dump(dict_, f, ensure_ascii=False)
+    @staticmethod
+    def add_pending_transaction_batch(payload: str):
+        """
+        Adds a JSON array or newline delimited JSON of transactions. Returns
+        (True, one result per transaction in order) or (False, reason) if
+        the batch is too big.
+        """
+        payload = payload.strip()
+        if payload.startswith("["):
+            items = json.loads(payload)
+        else:
+            items = [line for line in payload.splitlines() if line.strip()]
+        if len(items) > max_batch_transactions:
+            return False, f"At most {max_batch_transactions} transactions per batch"
+
+        results = [None] * len(items)
+        positions, txs = [], []
+        for position, item in enumerate(items):
+            try:
+                if isinstance(item, str):
+                    item = json.loads(item)
+                txs.append(transaction.createFromDictionary(item))
+                positions.append(position)
+            except Exception as err:
+                print(err)
+                results[position] = {"hash": None, "ok": False, "result": "Transaction not readable"}
+
+        added = Database._open_mempool().add_batch(txs, Database._open_verifier())
+        for position, tx, (is_valid, msg) in zip(positions, txs, added):
+            results[position] = {"hash": tx.hash, "ok": is_valid, "result": msg}
+        return True, results
+
+    @staticmethod
+    def clear_pending_transactions():
+        Database._open_mempool().clear()
 
     # this is not useful btw
     '''
@@ -198,7 +408,13 @@ class Database:
     async def get_transaction(transaction_hash: str):
         try:
             Chain = Database.import_blocks()
-            return Chain.getTransaction(transaction_hash)
+            location = Database.TxIndex.get(transaction_hash)
+            if location is None:
+                return None
+
+            block_hash, position = location
+            tx = Chain.blocks[block_hash].transactions[position]
+            return json.dumps(tx.asDict(), indent=2)
 
         except Exception as err:
             print(err)
@@ -207,8 +423,7 @@ class Database:
     @staticmethod
     async def get_block(block_hash: str):
         try:
-            Chain = Database.import_blocks()
-            return Chain.blocks[block_hash]
+            return Database._open_store().read_dict(block_hash)
 
         except Exception as err:
             print(err)
@@ -216,10 +431,15 @@ class Database:
 
     @staticmethod
     async def get_blocks(offset, limit):
+        """
+        Returns the main chain blocks at heights offset up to offset + limit.
+        """
         try:
-            Chain = Database.import_blocks()
-            # print(Chain.getAncestors(child=Chain.head, n=limit))
-            return Chain.blocks
+            store = Database._open_store()
+            blocks = {}
+            for block_hash in Database.import_blocks().getMainChainHashes(offset, limit):
+                blocks[block_hash] = store.read_dict(block_hash)
+            return blocks
 
         except Exception as err:
             print(err)
@@ -228,8 +448,7 @@ class Database:
     @staticmethod
     async def get_pending_transactions():
         try:
-            transactions = Database.import_pending_transactions(pending_transaction_file)
-            return transactions
+            return Database._open_mempool().as_dicts()
 
         except Exception as err:
             print(err)
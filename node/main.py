@@ -46,6 +46,11 @@ app.add_middleware(
 )
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    Database.close()
+
+
 async def propagate(path: str, args: dict, ignore_url=None, nodes: list = None):
     global self_url
     self_node = NodeInterface(self_url or '')
@@ -106,8 +111,7 @@ async def get_difficulty(request: Request, block_hash: str):
 @app.get("/eth_blockNumber")
 async def eth_block_number(request: Request):
     try:
-        Chain = Database.import_blocks()
-        return JSONResponse(content={"jsonrpc": "2.0", "id": 1, "result": hex(len(Chain.blocks)-1)})
+        return JSONResponse(content={"jsonrpc": "2.0", "id": 1, "result": hex(Database.get_last_index())})
     except Exception as e:
         print(e)
         return JSONResponse(content={"jsonrpc": "2.0", "id": 1, "error": "Could not retrieve block number"})
@@ -145,7 +149,7 @@ async def add_new_block(request: Request, new_block: str):
 @limiter.limit("2/second")
 async def add_transaction(request: Request, pending_transaction: str):
     try:
-        tx = Database.add_pending_transactions(pending_transaction_file, pending_transaction)
+        tx = Database.add_pending_transactions(pending_transaction)
     except Exception as err:
         print(err)
         return {'ok': False, 'result': 'Transaction not created'}
@@ -155,6 +159,19 @@ async def add_transaction(request: Request, pending_transaction: str):
         return {'ok': True, 'result': "Transaction added to pending transactions"}
 
 
+@app.post("/add_transactions")
+@limiter.limit("10/minute")
+async def add_transactions(request: Request):
+    try:
+        is_valid, result = Database.add_pending_transaction_batch((await request.body()).decode("utf-8"))
+    except Exception as err:
+        print(err)
+        return {'ok': False, 'error': 'Transactions not readable'}
+    if not is_valid:
+        return {'ok': False, 'error': result}
+    return {'ok': True, 'result': result}
+
+
 @app.get("/get_transaction")
 @limiter.limit("2/second")
 async def get_transaction(request: Request, tx_hash: str):
@@ -164,12 +181,52 @@ async def get_transaction(request: Request, tx_hash: str):
     return {'ok': True, 'result': tx}
 
 
+@app.get("/get_balance")
+@limiter.limit("10/second")
+async def get_balance(request: Request, address: str):
+    try:
+        return {'ok': True, 'result': Database.get_balance(address)}
+    except Exception as err:
+        print(err)
+        return {'ok': False, 'error': 'Could not get balance'}
+
+
+@app.get("/get_utxos")
+@limiter.limit("10/second")
+async def get_utxos(request: Request, address: str, offset: int = Query(default=0, ge=0), limit: int = Query(default=100, ge=1, le=1000)):
+    try:
+        return {'ok': True, 'result': Database.get_utxos(address, offset, limit)}
+    except Exception as err:
+        print(err)
+        return {'ok': False, 'error': 'Could not get unspent outputs'}
+
+
 @app.get("/get_pending_transactions")
 async def get_blocks(request: Request):
     transactions = await Database.get_pending_transactions()
     return {'ok': True, 'result': transactions}
 
 
+@app.get("/get_block_template")
+@limiter.limit("30/minute")
+async def get_block_template(request: Request):
+    try:
+        return {'ok': True, 'result': Database.get_block_template()}
+    except Exception as err:
+        print(err)
+        return {'ok': False, 'error': 'Could not build a block template'}
+
+
+@app.get("/get_work")
+@limiter.limit("60/minute")
+async def get_work(request: Request):
+    try:
+        return {'ok': True, 'result': Database.get_work()}
+    except Exception as err:
+        print(err)
+        return {'ok': False, 'error': 'Could not build work'}
+
+
 @app.get("/get_block")
 @limiter.limit("30/minute")
 async def get_block(request: Request, block_hash: str):
@@ -197,8 +254,7 @@ async def get_json_blocks(request: Request):
 @app.get("/get_last_index")
 async def get_last_index(request: Request):
     try:
-        Chain = Database.import_blocks()
-        return len(Chain.blocks)-1
+        return Database.get_last_index()
     except:
         return {'ok': False}
 
@@ -207,17 +263,13 @@ async def get_last_index(request: Request):
 @limiter.limit("30/minute")
 async def get_last_hash(request: Request):
     try:
-        Chain = Database.import_blocks()
-        hashes = []
-        for blocks in Chain.blocks:
-            hashes.append(blocks)
-        return hashes[-1]
+        return Database.get_last_hash()
     except:
         return {'ok': False}
 
 
 @app.get("/get_blocks")
 @limiter.limit("10/minute")
-async def get_blocks(request: Request, offset: int, limit: int = Query(default=..., le=1000)):
+async def get_blocks(request: Request, offset: int = Query(default=..., ge=0), limit: int = Query(default=..., ge=0, le=1000)):
     blocks = await Database.get_blocks(offset, limit)
     return {'ok': True, 'result': blocks}
@@ -0,0 +1,556 @@
+import heapq
+import itertools
+import json
+import os
+import time
+from typing import Dict, List, Set, Tuple
+
+import sys
+
+# Add the path to the parent directory of 'blockchain'
+sys.path.append(os.path.abspath('../blockchain'))
+sys.path.append(os.path.abspath('../node'))
+import chain, transaction
+
+# Transactions handed to a verification worker at a time.
+VERIFY_CHUNK_SIZE = 16
+
+
+class MempoolEntry:
+    """
+    A pending transaction, its fee, its serialized size and the time the
+    node first saw it.
+    """
+    __slots__ = ("tx", "arrival", "fee", "size", "sequence")
+
+    def __init__(
+            self,
+            tx: transaction.Transaction,
+            arrival: float,
+            fee: float = 0,
+            size: int = 0) -> None:
+        self.tx = tx
+        self.arrival = arrival
+        self.fee = fee
+        self.size = size
+        self.sequence = 0
+
+    def priority(self) -> tuple:
+        """
+        Sort key of the entry, the highest fee and then the oldest first.
+        """
+        return -self.fee, self.arrival, self.sequence
+
+    def eviction_priority(self) -> tuple:
+        """
+        Sort key for eviction, the lowest fee and then the newest first.
+        """
+        return self.fee, -self.arrival, -self.sequence
+
+
+class Mempool:
+    """
+    The pending transactions of the node, kept in memory and keyed by
+    transaction hash.
+
+    The pool also indexes which pending transaction spends each outpoint.
+    It is registered as a chain listener: a connected block removes the
+    transactions it includes and the ones that conflict with its inputs,
+    a disconnected block gives its transactions back to the pool.
+
+    New transactions are checked against the UTXO set of the given chain
+    with the outputs of pending transactions layered on top, so chained
+    unconfirmed spends are accepted and double spends are not. Without a
+    chain only the syntax and conflicts with the pool are checked.
+
+    If a journal path is given, every addition and removal is appended to
+    it as one JSON line, and the pool is rebuilt from it on start. The
+    journal is compacted on load when it holds removed transactions.
+
+    Entries are ordered by fee and then arrival time in a heap. A fee is
+    what the inputs pay above the outputs. The current consensus rules
+    require the two to be equal, so every fee is 0 for now and the order
+    is the arrival order.
+
+    The pool holds at most max_count transactions and max_bytes of
+    serialized transactions. When it is full, a better new transaction
+    evicts the lowest priority ones together with their descendants.
+    Transactions older than ttl seconds expire.
+    """
+
+    def __init__(
+            self,
+            journal_path: str = None,
+            pool_chain: chain.Chain = None,
+            max_count: int = None,
+            max_bytes: int = None,
+            ttl: float = None) -> None:
+        self.entries: Dict[str, MempoolEntry] = {}
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        # outpoint key -> hash of the pending transaction spending it
+        self.spends: Dict[bytes, str] = {}
+        self.chain = pool_chain
+        # Transactions of disconnected blocks, oldest block first.
+        self.disconnected: List[transaction.Transaction] = []
+        # (priority, hash) of the entries, removed entries are skipped lazily
+        self.queue: List[Tuple[tuple, str]] = []
+        self.eviction_queue: List[Tuple[tuple, str]] = []
+        self._sequence = itertools.count(1)
+        # Bumped on every change, so callers can cache what they derive.
+        self.version = 0
+        self.journal_path = journal_path
+        self._journal = None
+
+        if journal_path is not None:
+            removed = self._load()
+            if removed > 0:
+                self._compact()
+            self._journal = open(journal_path, "a", encoding="utf-8")
+
+    def _load(self) -> int:
+        if not os.path.exists(self.journal_path):
+            return 0
+
+        removed = 0
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash.
+                    removed += 1
+                    continue
+                if "add" in record:
+                    tx = transaction.createFromDictionary(record["add"])
+                    self._insert(MempoolEntry(
+                        tx, record["time"], record.get("fee", 0), len(line)))
+                elif self._delete(record["remove"]) is not None:
+                    removed += 1
+        return removed
+
+    def _compact(self) -> None:
+        temporary = self.journal_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for entry in self.entries.values():
+                f.write(self._add_record(entry))
+        os.replace(temporary, self.journal_path)
+
+    @staticmethod
+    def _add_record(entry: MempoolEntry) -> str:
+        return json.dumps(
+            {"add": entry.tx.asDict(), "time": entry.arrival, "fee": entry.fee},
+            separators=(",", ":")) + "\n"
+
+    @staticmethod
+    def _input_keys(tx: transaction.Transaction) -> List[bytes]:
+        return [
+            chain.outpointKey(tInput.referencedHash, tInput.referencedOutputIndex)
+            for tInput in tx.inputs]
+
+    def _insert(self, entry: MempoolEntry) -> None:
+        if entry.sequence == 0:
+            entry.sequence = next(self._sequence)
+        self.entries[entry.tx.hash] = entry
+        self.version += 1
+        for key in self._input_keys(entry.tx):
+            self.spends[key] = entry.tx.hash
+
+        self.total_bytes += entry.size
+
+        heapq.heappush(self.queue, (entry.priority(), entry.tx.hash))
+        heapq.heappush(self.eviction_queue, (entry.eviction_priority(), entry.tx.hash))
+        if len(self.queue) > 2 * len(self.entries) + 64:
+            self.queue = [
+                (entry.priority(), tx_hash) for tx_hash, entry in self.entries.items()]
+            heapq.heapify(self.queue)
+            self.eviction_queue = [
+                (entry.eviction_priority(), tx_hash) for tx_hash, entry in self.entries.items()]
+            heapq.heapify(self.eviction_queue)
+
+    def _delete(self, tx_hash: str) -> MempoolEntry:
+        entry = self.entries.pop(tx_hash, None)
+        if entry is not None:
+            self.version += 1
+            self.total_bytes -= entry.size
+            for key in self._input_keys(entry.tx):
+                if self.spends.get(key, None) == tx_hash:
+                    del self.spends[key]
+        return entry
+
+    def _write(self, line: str) -> None:
+        if self._journal is not None:
+            self._journal.write(line)
+            self._journal.flush()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, tx_hash: str) -> bool:
+        return tx_hash in self.entries
+
+    def get(self, tx_hash: str) -> transaction.Transaction:
+        entry = self.entries.get(tx_hash, None)
+        return entry.tx if entry is not None else None
+
+    def get_output(self, tx_hash: str, output_index: int) -> Tuple[float, str]:
+        """
+        Looks an unspent output up in the chain UTXO set and the outputs of
+        pending transactions. Returns (amount, address) or None.
+        """
+        entry = self.entries.get(tx_hash, None)
+        if entry is not None:
+            if not isinstance(output_index, int) or not 0 <= output_index < len(entry.tx.outputs):
+                return None
+            output = entry.tx.outputs[output_index]
+            return output.amount, output.address
+        return self.chain.utxo.getOutput(tx_hash, output_index)
+
+    def check(self, tx: transaction.Transaction, verified: bool = False) -> Tuple[bool, str]:
+        """
+        Checks whether a transaction can join the pool. The cheap checks run
+        first and the signatures last. Returns (True, fee) or (False, reason).
+        verified skips the syntax and signature checks add_batch already did.
+        """
+        if tx.hash in self.entries:
+            return False, "Transaction already in the mempool"
+        if not tx.inputs:
+            return False, "Coinbase transaction don't needed in pending"
+
+        if not verified:
+            is_valid, msg = chain.verifyTransactionSyntax([tx])
+            if not is_valid:
+                return False, msg
+
+        for key in self._input_keys(tx):
+            if key is None:
+                return False, "Input references an invalid outpoint"
+            if key in self.spends:
+                return False, "Transaction conflicts with a pending transaction"
+
+        if self.chain is None:
+            return True, 0
+
+        referenced = []
+        for tInput in tx.inputs:
+            output = self.get_output(tInput.referencedHash, tInput.referencedOutputIndex)
+            if output is None:
+                return False, "Referenced UTXO does not exist."
+            referenced.append(output)
+
+        input_amounts = sum(amount for amount, _ in referenced)
+        output_amounts = sum(tOutput.amount for tOutput in tx.outputs)
+        if input_amounts != output_amounts:
+            return False, "Input amounts to do not match output amounts"
+
+        if not verified:
+            is_valid, msg = transaction.verifySignatures(tx, [address for _, address in referenced])
+            if not is_valid:
+                return False, msg
+        return True, input_amounts - output_amounts
+
+    def add(self, tx: transaction.Transaction) -> Tuple[bool, str]:
+        """
+        Adds a transaction to the pool if check() accepts it.
+        """
+        self.expire()
+        is_valid, result = self.check(tx)
+        if not is_valid:
+            return False, result
+        return self._admit(tx, result)
+
+    def add_batch(self, txs: List[transaction.Transaction], executor=None) -> List[Tuple[bool, str]]:
+        """
+        Adds many transactions at once and returns the result of each, in
+        order. Duplicates and syntax errors are rejected in one pass, the
+        signatures of the rest are verified on the executor if one is given,
+        then the transactions are admitted in order, so a transaction may
+        spend the outputs of an earlier one in the same batch.
+        """
+        self.expire()
+        results: List[Tuple[bool, str]] = [None] * len(txs)
+        # hash -> transaction of the batch that passed the first pass
+        batch: Dict[str, transaction.Transaction] = {}
+        positions, jobs, addresses = [], [], []
+
+        for position, tx in enumerate(txs):
+            if tx.hash in batch:
+                results[position] = False, "Duplicate transaction in the batch"
+                continue
+            if tx.hash in self.entries:
+                results[position] = False, "Transaction already in the mempool"
+                continue
+            if not tx.inputs:
+                results[position] = False, "Coinbase transaction don't needed in pending"
+                continue
+            is_valid, msg = chain.verifyTransactionSyntax([tx])
+            if not is_valid:
+                results[position] = False, msg
+                continue
+
+            tx_addresses = []
+            if self.chain is not None:
+                for tInput in tx.inputs:
+                    parent = batch.get(tInput.referencedHash, None)
+                    if parent is not None:
+                        output_index = tInput.referencedOutputIndex
+                        if not isinstance(output_index, int) or not 0 <= output_index < len(parent.outputs):
+                            break
+                        tx_addresses.append(parent.outputs[output_index].address)
+                        continue
+                    output = self.get_output(tInput.referencedHash, tInput.referencedOutputIndex)
+                    if output is None:
+                        break
+                    tx_addresses.append(output[1])
+                if len(tx_addresses) != len(tx.inputs):
+                    results[position] = False, "Referenced UTXO does not exist."
+                    continue
+
+            batch[tx.hash] = tx
+            positions.append(position)
+            jobs.append(tx)
+            addresses.append(tx_addresses)
+
+        workers = executor is not None and len(jobs) > 1
+        if workers:
+            verified = executor.map(
+                transaction.verifySignatures, jobs, addresses, chunksize=VERIFY_CHUNK_SIZE)
+        else:
+            verified = map(transaction.verifySignatures, jobs, addresses)
+
+        for position, tx, tx_addresses, (is_valid, msg) in zip(positions, jobs, addresses, verified):
+            if not is_valid:
+                results[position] = False, msg
+                continue
+            if workers:
+                # The workers filled their own signature caches, not ours.
+                transaction.signatureCache.addTransaction(tx, tx_addresses)
+            is_valid, result = self.check(tx, verified=True)
+            results[position] = self._admit(tx, result) if is_valid else (False, result)
+        return results
+
+    def _admit(self, tx: transaction.Transaction, fee: float) -> Tuple[bool, str]:
+        entry = MempoolEntry(tx, time.time(), fee)
+        entry.sequence = next(self._sequence)
+        record = self._add_record(entry)
+        entry.size = len(record)
+        if not self._make_room(entry):
+            return False, "Mempool is full"
+
+        self._insert(entry)
+        self._write(record)
+        return True, "Transaction added"
+
+    def _is_full(self, size: int, count: int, total_bytes: int) -> bool:
+        return (self.max_count is not None and count + 1 > self.max_count) \
+            or (self.max_bytes is not None and total_bytes + size > self.max_bytes)
+
+    def _eviction_order(self):
+        """
+        Yields the entries in the order they would be evicted, walking the
+        eviction queue without popping it.
+        """
+        queue = self.eviction_queue
+        frontier = [(queue[0], 0)] if queue else []
+        while frontier:
+            (priority, tx_hash), i = heapq.heappop(frontier)
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(queue):
+                    heapq.heappush(frontier, (queue[child], child))
+            entry = self.entries.get(tx_hash, None)
+            if entry is not None and entry.eviction_priority() == priority:
+                yield entry
+
+    def _descendants(self, tx_hash: str, planned: set) -> set:
+        """
+        The transaction and every pending transaction that spends its
+        outputs, leaving out those already planned for eviction.
+        """
+        found = set()
+        stack = [tx_hash]
+        while stack:
+            tx_hash = stack.pop()
+            if tx_hash in found or tx_hash in planned:
+                continue
+            found.add(tx_hash)
+            for i in range(len(self.entries[tx_hash].tx.outputs)):
+                spender = self.spends.get(chain.outpointKey(tx_hash, i), None)
+                if spender is not None:
+                    stack.append(spender)
+        return found
+
+    def _make_room(self, entry: MempoolEntry) -> bool:
+        """
+        Evicts lower priority transactions, with their pending spenders,
+        until the entry fits. Nothing is evicted if the entry is not better
+        than what it would have to evict, or if its own pending parents
+        would have to go.
+        """
+        parents = {
+            tInput.referencedHash for tInput in entry.tx.inputs
+            if tInput.referencedHash in self.entries}
+        planned = set()
+        count, total_bytes = len(self.entries), self.total_bytes
+        candidates = self._eviction_order()
+        while self._is_full(entry.size, count, total_bytes):
+            worst = next(candidates, None)
+            if worst is None or worst.priority() <= entry.priority():
+                return False
+            evicted = self._descendants(worst.tx.hash, planned)
+            if evicted & parents:
+                return False
+            planned |= evicted
+            count -= len(evicted)
+            total_bytes -= sum(self.entries[tx_hash].size for tx_hash in evicted)
+
+        for tx_hash in planned:
+            self.evict(tx_hash)
+        return True
+
+    def expire(self, now: float = None) -> None:
+        """
+        Evicts the transactions that arrived more than ttl seconds ago.
+        """
+        if self.ttl is None:
+            return
+        cutoff = (now if now is not None else time.time()) - self.ttl
+        expired = []
+        for tx_hash, entry in self.entries.items():
+            if entry.arrival >= cutoff:
+                break
+            expired.append(tx_hash)
+        for tx_hash in expired:
+            self.evict(tx_hash)
+
+    def remove(self, tx_hash: str) -> bool:
+        if self._delete(tx_hash) is None:
+            return False
+        self._write(json.dumps({"remove": tx_hash}) + "\n")
+        return True
+
+    def evict(self, tx_hash: str) -> None:
+        """
+        Removes a transaction and every pending transaction that spends its
+        outputs, directly or through other pending transactions.
+        """
+        entry = self.entries.get(tx_hash, None)
+        if entry is None:
+            return
+        self.remove(tx_hash)
+        self._evict_spenders(entry.tx)
+
+    def _evict_spenders(self, tx: transaction.Transaction) -> None:
+        for i in range(len(tx.outputs)):
+            spender = self.spends.get(chain.outpointKey(tx.hash, i), None)
+            if spender is not None:
+                self.evict(spender)
+
+    def _evict_orphans(self, tx: transaction.Transaction) -> None:
+        """
+        Evicts the pending spends of a transaction that could not come back
+        to the pool, unless the output they spend is in the chain because
+        the new branch includes the transaction too.
+        """
+        if tx.hash in self.entries:
+            return
+        for i in range(len(tx.outputs)):
+            spender = self.spends.get(chain.outpointKey(tx.hash, i), None)
+            if spender is None:
+                continue
+            if self.chain is None or self.chain.utxo.getOutput(tx.hash, i) is None:
+                self.evict(spender)
+
+    def clear(self) -> None:
+        for tx_hash in list(self.entries):
+            self.remove(tx_hash)
+
+    def get_spender(self, tx_hash: str, output_index: int) -> str:
+        """
+        Returns the hash of the pending transaction spending an output, or
+        None.
+        """
+        return self.spends.get(chain.outpointKey(tx_hash, output_index), None)
+
+    def blockConnected(self, connected) -> None:
+        # A reorg disconnects blocks newest first and then connects the new
+        # branch, after the chain already moved to its new tip. Putting the
+        # old transactions back oldest first keeps chained spends valid.
+        if self.disconnected:
+            disconnected = self.disconnected
+            self.disconnected = []
+            for tx in disconnected:
+                if not self.add(tx)[0]:
+                    self._evict_orphans(tx)
+
+        self.expire()
+        if not self.entries:
+            return
+        for tx in connected.transactions:
+            # Pending spends of a mined transaction stay valid.
+            self.remove(tx.hash)
+            for key in self._input_keys(tx):
+                conflicting = self.spends.get(key, None)
+                if conflicting is not None:
+                    self.evict(conflicting)
+
+    def blockDisconnected(self, disconnected) -> None:
+        for tx in disconnected.transactions:
+            if not tx.inputs:
+                # The outputs of a disconnected coinbase are gone.
+                self._evict_spenders(tx)
+        self.disconnected = [
+            tx for tx in disconnected.transactions if tx.inputs] + self.disconnected
+
+    def select(self, limit: int) -> List[transaction.Transaction]:
+        """
+        Returns up to limit transactions in priority order, where a
+        transaction that spends the output of another pending transaction
+        always comes after it.
+        """
+        queue = list(self.queue)
+        selected: List[transaction.Transaction] = []
+        chosen: Set[str] = set()
+        # pending parent hash -> children waiting for it
+        waiting: Dict[str, List[MempoolEntry]] = {}
+        missing: Dict[str, int] = {}
+
+        while queue and len(selected) < limit:
+            priority, tx_hash = heapq.heappop(queue)
+            entry = self.entries.get(tx_hash, None)
+            if entry is None or entry.priority() != priority or tx_hash in chosen:
+                continue
+
+            if tx_hash not in missing:
+                parents = {
+                    tInput.referencedHash for tInput in entry.tx.inputs
+                    if tInput.referencedHash in self.entries
+                    and tInput.referencedHash not in chosen}
+                missing[tx_hash] = len(parents)
+                for parent in parents:
+                    waiting.setdefault(parent, []).append(entry)
+            if missing[tx_hash] > 0:
+                continue
+
+            selected.append(entry.tx)
+            chosen.add(tx_hash)
+            for child in waiting.pop(tx_hash, []):
+                missing[child.tx.hash] -= 1
+                if missing[child.tx.hash] == 0:
+                    heapq.heappush(queue, (child.priority(), child.tx.hash))
+        return selected
+
+    def transactions(self) -> List[transaction.Transaction]:
+        """
+        Returns the pending transactions in arrival order.
+        """
+        return [entry.tx for entry in self.entries.values()]
+
+    def as_dicts(self) -> List[dict]:
+        return [entry.tx.asDict() for entry in self.entries.values()]
+
+    def close(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,15 @@
+import argparse
+
+from block_store import BlockStore, migrate_legacy_blocks
+from settings import legacy_blocks_directory, block_store_directory, block_segment_size
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a blocks/ directory of block{index}.json files into the block store.")
+    parser.add_argument("--blocks", default=legacy_blocks_directory, help="directory with block{index}.json files")
+    parser.add_argument("--store", default=block_store_directory, help="block store directory")
+    args = parser.parse_args()
+
+    store = BlockStore(args.store, block_segment_size)
+    migrated = migrate_legacy_blocks(store, args.blocks)
+    store.close()
+    print(f"Migrated {migrated} blocks into {args.store}")
@@ -0,0 +1,6 @@
+from database import Database
+
+if __name__ == "__main__":
+    Database.init()
+    Database.reindex()
+    print(f"Indexed {len(Database.TxIndex)} transactions")
@@ -1 +1,15 @@
 pending_transaction_file = "pending_transactions"
+legacy_blocks_directory = "blocks"
+block_store_directory = "blockstore"
+block_segment_size = 128 * 1024 * 1024  # 128 MB per segment file
+utxo_snapshot_interval = 100  # blocks between UTXO snapshots
+utxo_backend = "memory"  # "memory" keeps the UTXO set in RAM, "sqlite" keeps it on disk
+utxo_cache_size = 64 * 1024 * 1024  # memory budget of the sqlite UTXO cache
+max_reorg_depth = 100  # side branches forking deeper than this below the tip are pruned
+mempool_journal = "mempool.journal"  # None keeps pending transactions in memory only
+mempool_max_count = 50000  # pending transactions kept before the lowest priority are evicted
+mempool_max_bytes = 32 * 1024 * 1024  # serialized size budget of the mempool
+mempool_ttl = 3 * 24 * 60 * 60  # seconds a pending transaction may wait before it expires
+max_batch_transactions = 1000  # transactions accepted by one /add_transactions request
+signature_workers = None  # processes verifying block and batch signatures, None uses every core
+assume_valid = None  # hash of a block whose signatures and its ancestors' are not checked on load
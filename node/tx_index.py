@@ -0,0 +1,118 @@
+import os
+import struct
+from typing import Dict, Tuple
+
+import sys
+
+# Add the path to the parent directory of 'blockchain'
+sys.path.append(os.path.abspath('../blockchain'))
+sys.path.append(os.path.abspath('../node'))
+import block as chain_helper
+
+TX_INDEX_NAME = "txindex.dat"
+
+# operation, transaction hash, block hash, position in the block
+TX_INDEX_RECORD = struct.Struct(">B32s32sI")
+ADD = 1
+REMOVE = 0
+
+
+class TransactionIndex:
+    """
+    Maps transaction hashes to the (block hash, position) of the main chain
+    block that contains them.
+
+    The index is persisted as an append-only log of add and remove records
+    next to the block store. It is registered as a chain listener, so it
+    follows the main chain through block connects, disconnects and reorgs.
+    Connecting a block that is already indexed writes nothing, which makes
+    replaying the chain at startup cheap.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.path = os.path.join(directory, TX_INDEX_NAME)
+        self.entries: Dict[bytes, Tuple[bytes, int]] = {}
+
+        os.makedirs(directory, exist_ok=True)
+        removed = self._load()
+        if removed > 0:
+            self._compact()
+        self._file = open(self.path, "ab")
+
+    def _load(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+
+        removed = 0
+        for start in range(0, len(data) - TX_INDEX_RECORD.size + 1, TX_INDEX_RECORD.size):
+            operation, tx_hash, block_hash, position = \
+                TX_INDEX_RECORD.unpack_from(data, start)
+            if operation == ADD:
+                self.entries[tx_hash] = (block_hash, position)
+            elif self.entries.get(tx_hash, (None,))[0] == block_hash:
+                del self.entries[tx_hash]
+                removed += 1
+
+        # A partially written record counts as garbage that needs compacting.
+        if len(data) % TX_INDEX_RECORD.size != 0:
+            removed += 1
+        return removed
+
+    def _compact(self) -> None:
+        """
+        Rewrites the log so that it only holds the live entries.
+        """
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            for tx_hash, (block_hash, position) in self.entries.items():
+                f.write(TX_INDEX_RECORD.pack(ADD, tx_hash, block_hash, position))
+        os.replace(temporary, self.path)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, tx_hash: str) -> Tuple[str, int]:
+        """
+        Returns the (block hash, position) of a transaction or None.
+        """
+        try:
+            entry = self.entries.get(bytes.fromhex(tx_hash), None)
+        except ValueError:
+            return None
+        if entry is None:
+            return None
+        return entry[0].hex(), entry[1]
+
+    def blockConnected(self, connected: chain_helper.Block) -> None:
+        block_hash = bytes.fromhex(connected.hash)
+        for position, tx in enumerate(connected.transactions):
+            tx_hash = bytes.fromhex(tx.hash)
+            if self.entries.get(tx_hash, None) == (block_hash, position):
+                continue
+            self.entries[tx_hash] = (block_hash, position)
+            self._file.write(TX_INDEX_RECORD.pack(ADD, tx_hash, block_hash, position))
+        self._file.flush()
+
+    def blockDisconnected(self, disconnected: chain_helper.Block) -> None:
+        block_hash = bytes.fromhex(disconnected.hash)
+        for position, tx in enumerate(disconnected.transactions):
+            tx_hash = bytes.fromhex(tx.hash)
+            if self.entries.get(tx_hash, (None,))[0] != block_hash:
+                continue
+            del self.entries[tx_hash]
+            self._file.write(TX_INDEX_RECORD.pack(REMOVE, tx_hash, block_hash, position))
+        self._file.flush()
+
+    def reset(self) -> None:
+        """
+        Drops every entry, used before rebuilding the index from the chain.
+        """
+        self._file.close()
+        self.entries = {}
+        self._file = open(self.path, "wb")
+
+    def close(self) -> None:
+        self._file.close()
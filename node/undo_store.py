@@ -0,0 +1,94 @@
+import json
+import os
+import struct
+from typing import Dict, List, Tuple
+
+import sys
+
+# Add the path to the parent directory of 'blockchain'
+sys.path.append(os.path.abspath('../blockchain'))
+sys.path.append(os.path.abspath('../node'))
+import chain
+
+UNDO_NAME = "undo.dat"
+
+# block hash, payload length
+UNDO_HEADER = struct.Struct(">32sI")
+
+
+class UndoStore:
+    """
+    Persists the undo record of every connected block next to the block
+    store: the outputs the block spent, as (transaction hash, output index,
+    amount, address) in spend order.
+
+    Records are appended to a log and the newest record of a block wins, so
+    a block that is disconnected and connected again just gets a new record.
+    The offsets of the records are kept in memory and a record is read back
+    only when its block is disconnected.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.path = os.path.join(directory, UNDO_NAME)
+        # block hash -> (offset of the payload, length)
+        self.records: Dict[str, Tuple[int, int]] = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self._file = open(self.path, "a+b")
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+
+        valid = 0
+        while valid + UNDO_HEADER.size <= len(data):
+            raw_hash, length = UNDO_HEADER.unpack_from(data, valid)
+            start = valid + UNDO_HEADER.size
+            if start + length > len(data):
+                break
+            self.records[raw_hash.hex()] = (start, length)
+            valid = start + length
+
+        # Cut off a partially written record.
+        if valid != len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _read(self, block_hash: str) -> bytes:
+        offset, length = self.records[block_hash]
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def put(self, block_hash: str, undo: List[Tuple[bytes, float, str]]) -> None:
+        payload = json.dumps(
+            [chain.splitOutpointKey(key) + (amount, address) for key, amount, address in undo],
+            separators=(",", ":")).encode("utf-8")
+
+        # Replaying stored blocks at startup connects them again, which
+        # should not grow the log.
+        if block_hash in self.records and self._read(block_hash) == payload:
+            return
+
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(UNDO_HEADER.pack(bytes.fromhex(block_hash), len(payload)))
+        offset = self._file.tell()
+        self._file.write(payload)
+        self._file.flush()
+        self.records[block_hash] = (offset, len(payload))
+
+    def get(self, block_hash: str) -> List[Tuple[bytes, float, str]]:
+        if block_hash not in self.records:
+            return None
+        return [
+            (chain.outpointKey(tx_hash, output_index), amount, address)
+            for tx_hash, output_index, amount, address in json.loads(self._read(block_hash))]
+
+    def close(self) -> None:
+        self._file.close()
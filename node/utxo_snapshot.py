@@ -0,0 +1,81 @@
+import json
+import os
+from typing import Tuple
+
+import sys
+
+# Add the path to the parent directory of 'blockchain'
+sys.path.append(os.path.abspath('../blockchain'))
+sys.path.append(os.path.abspath('../node'))
+import chain
+from Cryptodome.Hash import SHA256
+
+UTXO_SNAPSHOT_NAME = "utxo.snapshot"
+UTXO_SNAPSHOT_VERSION = 3
+
+
+class SnapshotException(Exception):
+    pass
+
+
+def write_snapshot(directory: str, snapshot_chain: chain.Chain) -> None:
+    """
+    Writes the UTXO set of the chain tip to disk.
+
+    The file starts with a JSON header line holding the format version, the
+    tip hash, the tip height and a SHA256 checksum of the payload. The
+    payload has one JSON line per unspent output. The outputs needed to
+    revert blocks are kept in the undo store instead. The file is written
+    next to the old one and then renamed over it, so a crash never leaves a
+    half written snapshot.
+    """
+    lines = []
+    for output in snapshot_chain.utxo.outputs():
+        lines.append(json.dumps({"output": output}, separators=(",", ":")))
+    payload = "\n".join(lines).encode("utf-8")
+
+    header = json.dumps({
+        "version": UTXO_SNAPSHOT_VERSION,
+        "tip": snapshot_chain.head.hash,
+        "height": snapshot_chain.head.index,
+        "checksum": SHA256.new(payload).hexdigest(),
+    }).encode("utf-8")
+
+    path = os.path.join(directory, UTXO_SNAPSHOT_NAME)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(header + b"\n" + payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def read_snapshot(directory: str) -> Tuple[str, int, chain.UTXOManager]:
+    """
+    Reads the snapshot written by write_snapshot. Returns the tip hash, the
+    tip height and the restored UTXO manager, or None if there is no
+    snapshot. Raises SnapshotException if the checksum does not match.
+    """
+    path = os.path.join(directory, UTXO_SNAPSHOT_NAME)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as f:
+        header, _, payload = f.read().partition(b"\n")
+
+    try:
+        header = json.loads(header)
+    except ValueError:
+        raise SnapshotException("Snapshot header is corrupt.")
+
+    if header.get("version", None) != UTXO_SNAPSHOT_VERSION:
+        raise SnapshotException("Snapshot version is not supported.")
+
+    if SHA256.new(payload).hexdigest() != header["checksum"]:
+        raise SnapshotException("Snapshot checksum does not match.")
+
+    manager = chain.UTXOManager()
+    for line in payload.splitlines():
+        manager.loadOutput(*json.loads(line)["output"])
+
+    return header["tip"], header["height"], manager
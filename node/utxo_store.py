@@ -0,0 +1,212 @@
+import os
+import sqlite3
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import sys
+
+# Add the path to the parent directory of 'blockchain'
+sys.path.append(os.path.abspath('../blockchain'))
+sys.path.append(os.path.abspath('../node'))
+import chain
+
+UTXO_DATABASE_NAME = "utxo.sqlite"
+
+# Rough size of one cached output: the dictionary slot, the 36 byte key,
+# the (amount, address) tuple and the float. Addresses are interned, so
+# they are shared between entries and not counted.
+CACHE_ENTRY_SIZE = 256
+
+# Outpoints bound in one query, below the SQLite default of 999 variables.
+SQL_VARIABLE_LIMIT = 500
+
+
+class SqliteUTXOBackend(chain.UTXOBackend):
+    """
+    Keeps the UTXO set in a SQLite database with a bounded write-back cache
+    in front of it.
+
+    Outputs created or spent since the last flush are held in memory as
+    dirty entries, spent ones as None. flush() is called at every block
+    boundary and writes them in one SQLite transaction together with the
+    hash of the block they belong to, so after a crash the database always
+    matches a whole block, which bestBlock() returns. Outputs that were read
+    or flushed are kept in a LRU cache until the memory budget is used up.
+    """
+
+    def __init__(self, path: str, cache_size: int = 64 * 1024 * 1024) -> None:
+        self.path = path
+        self.max_entries = max(1, cache_size // CACHE_ENTRY_SIZE)
+
+        # outpoint key -> (amount, address), least recently used first
+        self.cache: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+        # outpoint key -> (amount, address), or None if it was spent
+        self.dirty: Dict[bytes, Tuple[float, str]] = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS utxo ("
+            "outpoint BLOB PRIMARY KEY, amount, address TEXT NOT NULL, digest BLOB NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS utxo_digest ON utxo (digest)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.db.commit()
+
+        self.count = self.db.execute("SELECT COUNT(*) FROM utxo").fetchone()[0]
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'best_block'").fetchone()
+        self.best_block = row[0] if row is not None else None
+
+    def _cache(self, key: bytes, value: Tuple[float, str]) -> None:
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) + len(self.dirty) > self.max_entries and self.cache:
+            self.cache.popitem(last=False)
+
+    def get(self, key: bytes) -> Tuple[float, str]:
+        if key in self.dirty:
+            return self.dirty[key]
+
+        value = self.cache.get(key, None)
+        if value is not None:
+            self.cache.move_to_end(key)
+            return value
+
+        row = self.db.execute(
+            "SELECT amount, address FROM utxo WHERE outpoint = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value = (row[0], sys.intern(row[1]))
+        self._cache(key, value)
+        return value
+
+    def add(self, key: bytes, amount: float, address: str) -> None:
+        # New outputs are not looked up in the database, a transaction hash
+        # that is already unspent is rejected long before this.
+        if self.dirty.get(key, None) is None and self.cache.pop(key, None) is None:
+            self.count += 1
+        self.dirty[key] = (amount, sys.intern(address))
+
+    def remove(self, key: bytes) -> Tuple[float, str]:
+        value = self.get(key)
+        if value is None:
+            return None
+        self.cache.pop(key, None)
+        self.dirty[key] = None
+        self.count -= 1
+        return value
+
+    def items(self):
+        for key, amount, address in self.db.execute(
+                "SELECT outpoint, amount, address FROM utxo ORDER BY rowid"):
+            if key not in self.dirty:
+                yield key, amount, address
+        for key, value in self.dirty.items():
+            if value is not None:
+                yield (key,) + value
+
+    def __len__(self) -> int:
+        return self.count
+
+    def getAddressOutputs(
+            self,
+            address: str,
+            offset: int = 0,
+            limit: int = -1) -> List[Tuple[str, int, float]]:
+        # Dirty entries can hide stored rows, so read enough rows to still
+        # fill the page after they are dropped.
+        stored_limit = -1 if limit < 0 else offset + limit + len(self.dirty)
+        rows = self.db.execute(
+            "SELECT outpoint, amount FROM utxo WHERE digest = ? AND address = ? "
+            "ORDER BY rowid LIMIT ?",
+            (chain.addressDigest(address), address, stored_limit))
+
+        outputs = [
+            chain.splitOutpointKey(key) + (amount,)
+            for key, amount in rows if key not in self.dirty]
+        for key, value in self.dirty.items():
+            if value is not None and value[1] == address:
+                outputs.append(chain.splitOutpointKey(key) + (value[0],))
+
+        return outputs[offset:] if limit < 0 else outputs[offset:offset + limit]
+
+    def _addressTotals(self, address: str) -> Tuple[int, float]:
+        """
+        The number and the sum of the unspent outputs of an address,
+        counted in the database and corrected for the dirty entries.
+        """
+        digest = chain.addressDigest(address)
+        count, total = self.db.execute(
+            "SELECT COUNT(*), TOTAL(amount) FROM utxo WHERE digest = ? AND address = ?",
+            (digest, address)).fetchone()
+
+        # Dirty entries replace their stored rows.
+        keys = list(self.dirty)
+        for i in range(0, len(keys), SQL_VARIABLE_LIMIT):
+            chunk = keys[i:i + SQL_VARIABLE_LIMIT]
+            hidden, hidden_total = self.db.execute(
+                "SELECT COUNT(*), TOTAL(amount) FROM utxo WHERE digest = ? AND address = ? "
+                "AND outpoint IN ({})".format(", ".join("?" * len(chunk))),
+                [digest, address] + chunk).fetchone()
+            count -= hidden
+            total -= hidden_total
+        for value in self.dirty.values():
+            if value is not None and value[1] == address:
+                count += 1
+                total += value[0]
+        return count, total
+
+    def getAddressCount(self, address: str) -> int:
+        return self._addressTotals(address)[0]
+
+    def getBalance(self, address: str) -> float:
+        return self._addressTotals(address)[1]
+
+    def flush(self, tip_hash: str) -> None:
+        """
+        Writes the dirty outputs and the new best block in one transaction.
+        """
+        if not self.dirty and self.best_block == tip_hash:
+            return
+
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM utxo WHERE outpoint = ?",
+                [(key,) for key, value in self.dirty.items() if value is None])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO utxo (outpoint, amount, address, digest) "
+                "VALUES (?, ?, ?, ?)",
+                [(key, value[0], value[1], chain.addressDigest(value[1]))
+                 for key, value in self.dirty.items() if value is not None])
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('best_block', ?)",
+                (tip_hash,))
+
+        self.best_block = tip_hash
+        dirty = self.dirty
+        self.dirty = {}
+        for key, value in dirty.items():
+            if value is not None:
+                self._cache(key, value)
+
+    def bestBlock(self) -> str:
+        return self.best_block
+
+    def clear(self) -> None:
+        """
+        Drops every output, used before rebuilding the set from the blocks.
+        """
+        with self.db:
+            self.db.execute("DELETE FROM utxo")
+            self.db.execute("DELETE FROM meta")
+        self.cache.clear()
+        self.dirty = {}
+        self.count = 0
+        self.best_block = None
+
+    def close(self) -> None:
+        self.db.close()
@@ -46,4 +46,58 @@ class TestBlock(unittest.TestCase):
     def test_genesis(self):
         genesis = block.genesisBlock()
         print(genesis)
-        self.assertTrue(genesis is not None)
\ No newline at end of file
+        self.assertTrue(genesis is not None)
+
+
+class TestMine(unittest.TestCase):
+    def test_blockHasher(self):
+        transactions = [
+            transaction.createTransaction([TestBlock.public1], [250], time.time()),
+            transaction.createTransaction([TestBlock.public2], [250], time.time())]
+        for index, timestamp in ((1, time.time()), (180, 1725615747.25), (7, 12)):
+            hasher = mine.BlockHasher(index, timestamp, transactions)
+            for noonce in (0, 9, 10, 123456789):
+                self.assertEqual(
+                    hasher.hash(noonce),
+                    block.hashBlock(index, timestamp, transactions, noonce, "previous"))
+
+    def test_binaryProofOfWork(self):
+        base = block.genesisBlock().hash
+        for zeros in range(0, 8):
+            hash = "0" * zeros + "f" + base[zeros + 1:]
+            self.assertEqual(mine.checkProofOfWork(hash), max(zeros, 1))
+            for diff in range(1, 10):
+                self.assertEqual(mine.hasProofOfWork(hash, diff), int(hash[:diff], 16) == 0)
+        self.assertTrue(mine.hasProofOfWork("0" * 64, 70))
+        # Anything but a hex digest takes the string path.
+        self.assertEqual(mine.checkProofOfWork("00ab"), 2)
+        self.assertTrue(mine.hasProofOfWork("00" + base[2:], -62))
+
+        coinbase = transaction.createTransaction([TestBlock.public1], [250], time.time())
+        hasher = mine.BlockHasher(1, time.time(), [coinbase])
+        noonce = hasher.search(0, None, 2)
+        self.assertTrue(mine.hasProofOfWork(hasher.hash(noonce), 2))
+        self.assertFalse(any(
+            mine.hasProofOfWork(hasher.hash(earlier), 2) for earlier in range(noonce)))
+        self.assertIsNone(hasher.search(0, noonce, 2))
+
+    def test_parallelMatchesLoop(self):
+        coinbase = transaction.createTransaction([TestBlock.public1], [250], time.time())
+        chunkSize = mine.NONCE_CHUNK_SIZE
+        mine.NONCE_CHUNK_SIZE = 64
+        try:
+            for workers in (1, 3):
+                newBlock, hashes, seconds = mine.ParallelGenerateNextBlock(
+                    1, block.genesisBlock().hash, [coinbase], 3, workers)
+                self.assertEqual(len(hashes), workers)
+                self.assertGreaterEqual(sum(hashes), newBlock.noonce + 1)
+
+                # The smallest nonce wins, as in the single loop.
+                noonce = 0
+                while not mine.hasProofOfWork(block.hashBlock(
+                        1, newBlock.timestamp, [coinbase], noonce, newBlock.previousHash), 3):
+                    noonce += 1
+                self.assertEqual(newBlock.noonce, noonce)
+                self.assertTrue(mine.hasProofOfWork(newBlock.hash, 3))
+        finally:
+            mine.NONCE_CHUNK_SIZE = chunkSize
@@ -0,0 +1,210 @@
+import unittest
+import os
+import tempfile
+import time
+from AverCoin.blockchain import block, transaction, mine
+from AverCoin.node import block_store, tx_index, undo_store, utxo_snapshot, utxo_store
+from AverCoin.test import private1, public1, public2, public3
+
+
+class TestBlockStore(unittest.TestCase):
+    def createBlocks(self, count):
+        blocks = [block.genesisBlock()]
+        for i in range(count):
+            tx1 = transaction.createTransaction([public1], [250], time.time())
+            tx2 = transaction.createTransaction(
+                [public1], [250], time.time(), [tx1.hash], [0], [private1])
+            blocks.append(mine.generateNextBlock(blocks[-1], [tx1, tx2], 1))
+        return blocks
+
+    def test_appendAndRead(self):
+        blocks = self.createBlocks(3)
+        with tempfile.TemporaryDirectory() as directory:
+            store = block_store.BlockStore(directory, segment_size=2048)
+            for b in blocks:
+                store.append(b)
+
+            self.assertEqual(len(store), 4)
+            for b in blocks:
+                self.assertEqual(store.read(b.hash).hash, b.hash)
+            self.assertEqual(store.get_hashes(2), [blocks[2].hash])
+
+            # Small segments force a roll over to new segment files.
+            self.assertTrue(os.path.exists(os.path.join(directory, "blk00001.dat")))
+
+            with self.assertRaises(block_store.BlockStoreException):
+                store.append(blocks[1])
+            store.close()
+
+            # The index is persisted and the order of blocks is kept.
+            store = block_store.BlockStore(directory, segment_size=2048)
+            self.assertEqual(store.order, [b.hash for b in blocks])
+            self.assertEqual(store.read(blocks[3].hash).hash, blocks[3].hash)
+            store.close()
+
+    def test_tornIndexRecord(self):
+        blocks = self.createBlocks(2)
+        with tempfile.TemporaryDirectory() as directory:
+            store = block_store.BlockStore(directory)
+            for b in blocks:
+                store.append(b)
+            store.close()
+
+            with open(os.path.join(directory, block_store.INDEX_NAME), "ab") as f:
+                f.write(b"\x00" * 10)
+
+            store = block_store.BlockStore(directory)
+            self.assertEqual(len(store), 3)
+            newBlock = self.createBlocks(1)[1]
+            store.append(mine.generateNextBlock(blocks[-1], newBlock.transactions, 1))
+            store.close()
+
+            store = block_store.BlockStore(directory)
+            self.assertEqual(len(store), 4)
+            store.close()
+
+
+    def test_ancestors(self):
+        blocks = self.createBlocks(2)
+        side = mine.generateNextBlock(blocks[1], self.createBlocks(1)[1].transactions, 1)
+        with tempfile.TemporaryDirectory() as directory:
+            store = block_store.BlockStore(directory)
+            for b in blocks + [side]:
+                store.append(b)
+            self.assertEqual(
+                store.get_ancestors(side.hash), {side.hash, blocks[1].hash, blocks[0].hash})
+            self.assertEqual(store.get_ancestors("not a hash"), set())
+            store.close()
+
+
+class TestTransactionIndex(unittest.TestCase):
+    def test_connectAndDisconnect(self):
+        blocks = TestBlockStore().createBlocks(2)
+        with tempfile.TemporaryDirectory() as directory:
+            index = tx_index.TransactionIndex(directory)
+            for b in blocks:
+                index.blockConnected(b)
+
+            txHash = blocks[2].transactions[0].hash
+            self.assertEqual(index.get(txHash), (blocks[2].hash, 0))
+            self.assertIsNone(index.get("not a hash"))
+
+            index.blockDisconnected(blocks[2])
+            self.assertIsNone(index.get(txHash))
+            index.close()
+
+            # Removals are replayed and compacted away on load.
+            index = tx_index.TransactionIndex(directory)
+            self.assertEqual(len(index), 3)
+            self.assertIsNone(index.get(txHash))
+            self.assertEqual(
+                index.get(blocks[1].transactions[0].hash), (blocks[1].hash, 0))
+            index.close()
+
+
+class TestUndoStore(unittest.TestCase):
+    def test_reorgAfterRestart(self):
+        blocks = TestBlockStore().createBlocks(2)
+        b2alt = mine.generateNextBlock(blocks[1], TestBlockStore().createBlocks(1)[1].transactions, 1)
+        b3alt = mine.generateNextBlock(b2alt, TestBlockStore().createBlocks(1)[1].transactions, 1)
+        load = lambda b: undo_store.chain.block.createFromJSON(b.asJSON())
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = undo_store.UndoStore(directory)
+            undoChain = undo_store.chain.Chain(undo=store)
+            for b in blocks[1:]:
+                undoChain.addBlock(load(b))
+            spentOutput = (blocks[2].transactions[1].inputs[0].referencedHash, 0)
+            self.assertEqual(len(store.get(blocks[2].hash)), 1)
+            utxo_snapshot.write_snapshot(directory, undoChain)
+            store.close()
+
+            # Only the snapshot and the undo records survive the restart.
+            store = undo_store.UndoStore(directory)
+            self.assertEqual(len(store), 3)
+            _, _, manager = utxo_snapshot.read_snapshot(directory)
+            undoChain = undo_store.chain.Chain(undo=store)
+            undoChain.loadSnapshot([load(b) for b in blocks], manager)
+            self.assertIsNone(undoChain.utxo.getOutput(*spentOutput))
+
+            undoChain.addBlock(load(b2alt))
+            undoChain.addBlock(load(b3alt))
+            self.assertEqual(undoChain.head.hash, b3alt.hash)
+            self.assertIsNone(undoChain.utxo.getOutput(blocks[2].transactions[0].hash, 0))
+            self.assertEqual(undoChain.utxo.getBalance(public1), 750)
+            store.close()
+
+
+class TestUTXOSnapshot(unittest.TestCase):
+    def test_roundTrip(self):
+        blocks = TestBlockStore().createBlocks(2)
+        snapshotChain = utxo_snapshot.chain.Chain()
+        for b in blocks[1:]:
+            snapshotChain.addBlock(utxo_snapshot.chain.block.createFromJSON(b.asJSON()))
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(utxo_snapshot.read_snapshot(directory))
+            utxo_snapshot.write_snapshot(directory, snapshotChain)
+
+            tip, height, manager = utxo_snapshot.read_snapshot(directory)
+            self.assertEqual(tip, blocks[2].hash)
+            self.assertEqual(height, 2)
+            self.assertEqual(
+                sorted(manager.outputs()), sorted(snapshotChain.utxo.outputs()))
+            self.assertEqual(manager.getBalance(public1), 500)
+
+            # Flip a byte in the payload.
+            path = os.path.join(directory, utxo_snapshot.UTXO_SNAPSHOT_NAME)
+            with open(path, "r+b") as f:
+                f.seek(-2, os.SEEK_END)
+                f.write(b"0")
+            with self.assertRaises(utxo_snapshot.SnapshotException):
+                utxo_snapshot.read_snapshot(directory)
+
+
+class TestSqliteUTXOBackend(unittest.TestCase):
+    def test_flushAndReopen(self):
+        blocks = TestBlockStore().createBlocks(2)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, utxo_store.UTXO_DATABASE_NAME)
+            backend = utxo_store.SqliteUTXOBackend(path, cache_size=512)
+            manager = utxo_store.chain.UTXOManager(backend)
+            memoryChain = utxo_store.chain.Chain()
+            diskChain = utxo_store.chain.Chain(utxo=manager)
+            self.assertEqual(backend.bestBlock(), diskChain.head.hash)
+            for b in blocks[1:]:
+                memoryChain.addBlock(utxo_store.chain.block.createFromJSON(b.asJSON()))
+                diskChain.addBlock(utxo_store.chain.block.createFromJSON(b.asJSON()))
+
+            # Every block is flushed and the cache stays within its budget.
+            self.assertEqual(backend.bestBlock(), blocks[2].hash)
+            self.assertEqual(backend.dirty, {})
+            self.assertLessEqual(len(backend.cache), 2)
+            self.assertEqual(sorted(manager.outputs()), sorted(memoryChain.utxo.outputs()))
+            self.assertEqual(manager.getBalance(public1), 500)
+            self.assertEqual(manager.getAddressOutputs(public1, offset=1, limit=1),
+                             memoryChain.utxo.getAddressOutputs(public1, offset=1, limit=1))
+
+            # Counts and balances see the dirty entries over the stored rows.
+            spend = transaction.createTransaction(
+                [public2], [250], time.time(), [blocks[2].transactions[1].hash], [0], [private1])
+            spent = manager.spend(spend)
+            memorySpent = memoryChain.utxo.spend(spend)
+            for address in (public1, public2, public3):
+                self.assertEqual(manager.getAddressCount(address),
+                                 memoryChain.utxo.getAddressCount(address))
+                self.assertEqual(manager.getBalance(address),
+                                 memoryChain.utxo.getBalance(address))
+            manager.revert(spend, spent)
+            memoryChain.utxo.revert(spend, memorySpent)
+
+            # Unflushed changes are lost, the database stays at the last block.
+            manager.spend(blocks[1].transactions[0])
+            backend.close()
+            backend = utxo_store.SqliteUTXOBackend(path)
+            self.assertEqual(backend.bestBlock(), blocks[2].hash)
+            self.assertEqual(len(backend), len(memoryChain.utxo))
+            self.assertEqual(
+                sorted(utxo_store.chain.UTXOManager(backend).outputs()),
+                sorted(memoryChain.utxo.outputs()))
+            backend.close()
@@ -1,11 +1,30 @@
 import unittest
+from unittest import mock
+import random
 import time
+from concurrent.futures import ProcessPoolExecutor
 from AverCoin.blockchain import chain, transaction, mine
 from AverCoin.test import private1, private2, private3, public1, public2, public3
 from AverCoin.blockchain.constants import *
 
 
 class TestUTXOManager(unittest.TestCase):
+    def test_undecodableSignature(self):
+        manager = chain.UTXOManager()
+        tx1 = transaction.createTransaction([public1], [1000], time.time())
+        tx2 = transaction.createTransaction(["abcd"], [1000], time.time())
+        manager.spend(tx1)
+        manager.spend(tx2)
+
+        # Neither raises, both fail the transaction.
+        badSignature = transaction.createTransaction(
+            [public2], [1000], time.time(), [tx1.hash], [0], [private1])
+        badSignature.inputs[0].signature = "not hex"
+        self.assertEqual(manager.canSpend(badSignature), (False, "Invalid signature"))
+        badKey = transaction.createTransaction(
+            [public2], [1000], time.time(), [tx2.hash], [0], [private1])
+        self.assertEqual(manager.canSpend(badKey), (False, "Invalid signature"))
+
     def test_validSyntax(self):
         timestamp = time.time()
         tx1 = transaction.createTransaction([public1], [1000], timestamp)
@@ -121,11 +140,11 @@ class TestUTXOManager(unittest.TestCase):
         self.assertTrue(manager.canSpend(tx6)[0])
         self.assertTrue(chain.verifyTransactionsSyntax([tx5, tx6]))
         manager.spend(tx5)
-        manager.spend(tx6)
+        spent6 = manager.spend(tx6)
 
         # Revert the 500 transaction to 3. 3 should now have 2500,
         # 1 should now have 500.
-        manager.revert(tx6)
+        manager.revert(tx6, spent6)
 
         # Should not be able to spend 3000
         tx7 = transaction.createTransaction(
@@ -174,6 +193,35 @@ class TestUTXOManager(unittest.TestCase):
         self.assertFalse(manager.canSpend(tx7)[0])
 
 
+    def test_compactOutputs(self):
+        manager = chain.UTXOManager()
+        tx1 = transaction.createTransaction([public1], [1000], time.time())
+        manager.spend(tx1)
+        tx2 = transaction.createTransaction(
+            outputAddresses=[public1, public1],
+            outputAmounts=[400, 600],
+            timestamp=time.time(),
+            previousTransactionHashes=[tx1.hash],
+            previousOutputIndices=[0],
+            privateKeys=[private1]
+        )
+        spent = manager.spend(tx2)
+
+        # Both outputs share one interned address.
+        self.assertEqual(len(manager), 2)
+        self.assertIsNone(manager.getOutput(tx1.hash, 0))
+        self.assertEqual(manager.getOutput(tx2.hash, 1), (600, public1))
+        addressTable = manager.backend.addressTable
+        self.assertEqual(addressTable.references[addressTable.ids[public1]], 2)
+        self.assertIsNone(manager.getOutput("not a hash", 0))
+        self.assertIsNone(manager.getOutput(tx2.hash, -1))
+
+        manager.revert(tx2, spent)
+        self.assertEqual(manager.getOutput(tx1.hash, 0), (1000, public1))
+        with self.assertRaises(chain.UTXOException):
+            manager.revert(tx2, spent)
+
+
 class TestChain(unittest.TestCase):
     def test_createLongChainValid(self):
         # Genesis has 1000 coins
@@ -298,4 +346,337 @@ class TestChain(unittest.TestCase):
         b4alt = mine.generateNextBlock(b3alt, [tx5alt], MIN_MINING_DIFFICULTY)
         testChain.addBlock(b4alt)
         print(testChain.blocks)
-        assert testChain.head == b4alt
\ No newline at end of file
+        assert testChain.head == b4alt
+
+class RecordingListener:
+    def __init__(self):
+        self.events = []
+
+    def blockConnected(self, connected):
+        self.events.append(("connect", connected.hash))
+
+    def blockDisconnected(self, disconnected):
+        self.events.append(("disconnect", disconnected.hash))
+
+
+def createRewardBlock(parent):
+    tx1 = transaction.createTransaction([public1], [250], time.time())
+    tx2 = transaction.createTransaction(
+        outputAddresses=[public1],
+        outputAmounts=[250],
+        timestamp=time.time(),
+        previousTransactionHashes=[tx1.hash],
+        previousOutputIndices=[0],
+        privateKeys=[private1]
+    )
+    return mine.generateNextBlock(parent, [tx1, tx2], MIN_MINING_DIFFICULTY)
+
+
+class TestChainListeners(unittest.TestCase):
+    def test_connectAndReorg(self):
+        testChain = chain.Chain()
+        listener = RecordingListener()
+        testChain.addListener(listener)
+        self.assertEqual(listener.events, [("connect", testChain.head.hash)])
+
+        b1 = createRewardBlock(testChain.head)
+        testChain.addBlock(b1)
+        b2 = createRewardBlock(b1)
+        testChain.addBlock(b2)
+
+        # A side branch does not touch the main chain until it is longer.
+        b2alt = createRewardBlock(b1)
+        testChain.addBlock(b2alt)
+        self.assertEqual(listener.events[-1], ("connect", b2.hash))
+
+        b3alt = createRewardBlock(b2alt)
+        testChain.addBlock(b3alt)
+        self.assertEqual(listener.events[-3:], [
+            ("disconnect", b2.hash),
+            ("connect", b2alt.hash),
+            ("connect", b3alt.hash)])
+
+
+class TestForkChoice(unittest.TestCase):
+    def test_mostWorkWins(self):
+        testChain = chain.Chain()
+        b1 = createRewardBlock(testChain.head)
+        testChain.addBlock(b1)
+        b2 = createRewardBlock(b1)
+        testChain.addBlock(b2)
+        b3 = createRewardBlock(b2)
+        testChain.addBlock(b3)
+
+        # A shorter branch wins once it has more work behind it.
+        b2alt = mine.SimpleGenerateNextBlock(
+            b1.index + 1, b1.hash, createRewardBlock(b1).transactions,
+            MIN_MINING_DIFFICULTY + 2)
+        testChain.addBlock(b2alt)
+        self.assertEqual(testChain.head.hash, b3.hash)
+        b3alt = createRewardBlock(b2alt)
+        testChain.addBlock(b3alt)
+        self.assertEqual(testChain.head.hash, b3alt.hash)
+        self.assertEqual(
+            testChain.chainWork[b3alt.hash],
+            testChain.chainWork[b2alt.hash] + chain.blockWork(chain.checkProofOfWork(b2alt.hash)))
+        self.assertIsNone(testChain.utxo.getOutput(b3.transactions[0].hash, 0))
+
+    def test_retargetBlockWork(self):
+        def createWithProof(parent, diff, proof=None):
+            while True:
+                newBlock = mine.SimpleGenerateNextBlock(
+                    parent.index + 1, parent.hash, createRewardBlock(parent).transactions, diff)
+                if proof is None or chain.checkProofOfWork(newBlock.hash) == proof:
+                    return newBlock
+
+        # Every third block retargets to 3, above what its parent sets.
+        with mock.patch.object(chain, "CHANGING_DIFF_TIME", 3), \
+                mock.patch.object(chain.DifficultyTracker, "getUpdateDiff", return_value=3):
+            testChain = chain.Chain()
+            genesis = testChain.head
+            b1 = createWithProof(genesis, 1, 1)
+            testChain.addBlock(b1)
+            b2 = createWithProof(b1, 1, 1)
+            testChain.addBlock(b2)
+            b3 = createWithProof(b2, 3)
+            testChain.addBlock(b3)
+            self.assertEqual(
+                testChain.chainWork[b3.hash],
+                testChain.chainWork[b2.hash] + chain.blockWork(3))
+
+            # Counting b3 at what b2 sets, this branch would win. Counted at
+            # the retarget, b3 keeps the most work.
+            b1alt = createWithProof(genesis, 3, 3)
+            testChain.addBlock(b1alt)
+            b2alt = createWithProof(b1alt, 3)
+            testChain.addBlock(b2alt)
+            self.assertLess(testChain.chainWork[b2alt.hash], testChain.chainWork[b3.hash])
+            self.assertEqual(testChain.head.hash, b3.hash)
+
+    def test_pruneStaleBranches(self):
+        testChain = chain.Chain(reorgLimit=2)
+        b1 = createRewardBlock(testChain.head)
+        testChain.addBlock(b1)
+        b2 = createRewardBlock(b1)
+        testChain.addBlock(b2)
+        b2alt = createRewardBlock(b1)
+        testChain.addBlock(b2alt)
+        b3alt = createRewardBlock(b2alt)
+
+        b3 = createRewardBlock(b2)
+        testChain.addBlock(b3)
+        self.assertIn(b2alt.hash, testChain.blocks)
+        b4 = createRewardBlock(b3)
+        testChain.addBlock(b4)
+
+        # The branch forked at height 2, which is now at the reorg limit.
+        self.assertNotIn(b2alt.hash, testChain.blocks)
+        self.assertNotIn(b2alt.hash, testChain.chainWork)
+        self.assertEqual(sorted(testChain.heights), [3, 4])
+        with self.assertRaises(chain.NoParentException):
+            testChain.addBlock(b3alt)
+        with self.assertRaises(chain.StaleBlockException):
+            testChain.addBlock(createRewardBlock(b1))
+
+
+class TestMainChainIndex(unittest.TestCase):
+    def test_followsReorg(self):
+        testChain = chain.Chain()
+        genesis = testChain.head
+        b1 = createRewardBlock(genesis)
+        testChain.addBlock(b1)
+        b2 = createRewardBlock(b1)
+        testChain.addBlock(b2)
+        b2alt = createRewardBlock(b1)
+        testChain.addBlock(b2alt)
+        b3alt = createRewardBlock(b2alt)
+        testChain.addBlock(b3alt)
+
+        self.assertEqual(
+            testChain.mainChain, [genesis.hash, b1.hash, b2alt.hash, b3alt.hash])
+        self.assertEqual(testChain.getMainChainHashes(1, 2), [b1.hash, b2alt.hash])
+        self.assertEqual(testChain.getMainChainHashes(3, 10), [b3alt.hash])
+        self.assertEqual(
+            [b.hash for b in testChain.getChildren(b1)], [b2alt.hash, b3alt.hash])
+        # A parent off the main chain gets the whole chain after genesis.
+        self.assertEqual(len(testChain.getChildren(b2)), 3)
+        self.assertEqual(
+            [b.hash for b in testChain.getAncestors(b3alt, 2)], [b3alt.hash, b2alt.hash])
+        self.assertEqual(
+            [b.hash for b in testChain.getAncestors(b2)], [b2.hash, b1.hash])
+
+
+class TestSignatureCache(unittest.TestCase):
+    def test_buriedBlocksAreEvicted(self):
+        cache = chain.transaction.signatureCache
+        cache.clear()
+        testChain = chain.Chain(reorgLimit=10)
+        b1 = createRewardBlock(testChain.head)
+        testChain.addBlock(b1)
+        b2 = createRewardBlock(b1)
+        testChain.addBlock(b2)
+        self.assertEqual(len(cache), 2)
+
+        # The work of a block varies, so grow each branch until it wins.
+        alt = b1
+        while testChain.isMainChain(b2):
+            alt = createRewardBlock(alt)
+            testChain.addBlock(alt)
+
+        # A reorg connecting b2 again finds its signature in the cache.
+        hits = cache.hits
+        tip = b2
+        while not testChain.isMainChain(b2):
+            tip = createRewardBlock(tip)
+            testChain.addBlock(tip)
+        self.assertGreater(cache.hits, hits)
+
+        # b1 and b2 are buried at the reorg limit.
+        while testChain.head.index - testChain.reorgLimit < b2.index:
+            testChain.addBlock(createRewardBlock(testChain.head))
+        keys = set(cache.entries)
+        for buried in (b1, b2):
+            self.assertTrue(keys.isdisjoint(cache._keys(buried.transactions[1])))
+        self.assertFalse(keys.isdisjoint(cache._keys(testChain.head.transactions[1])))
+
+    def test_parallelVerification(self):
+        cache = chain.transaction.signatureCache
+        tx1 = transaction.createTransaction([public1], [250], time.time())
+        tx2 = transaction.createTransaction(
+            [public2], [250], time.time(), [tx1.hash], [0], [private1])
+        tx3 = transaction.createTransaction(
+            [public3], [250], time.time(), [tx2.hash], [0], [private2])
+        forged = transaction.createTransaction(
+            [public3], [250], time.time(), [tx2.hash], [0], [private3])
+
+        with ProcessPoolExecutor(2) as executor:
+            testChain = chain.Chain(verifier=executor)
+            cache.clear()
+            with self.assertRaises(chain.UTXOException):
+                testChain.addBlock(mine.generateNextBlock(
+                    testChain.head, [tx1, tx2, forged], MIN_MINING_DIFFICULTY))
+
+            # The workers verified both spends, connecting only hits the cache.
+            cache.clear()
+            misses = cache.misses
+            b1 = mine.generateNextBlock(testChain.head, [tx1, tx2, tx3], MIN_MINING_DIFFICULTY)
+            testChain.addBlock(b1)
+            self.assertEqual(testChain.head.hash, b1.hash)
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.misses, misses)
+
+
+class TestAssumeValid(unittest.TestCase):
+    def test_skipsSignatures(self):
+        tx1 = transaction.createTransaction([public1], [250], time.time())
+        forged = transaction.createTransaction(
+            [public3], [250], time.time(), [tx1.hash], [0], [private3])
+        tooMuch = transaction.createTransaction(
+            [public3], [500], time.time(), [tx1.hash], [0], [private3])
+        b1 = mine.generateNextBlock(chain.block.genesisBlock(), [tx1, forged], MIN_MINING_DIFFICULTY)
+        b1bad = mine.generateNextBlock(chain.block.genesisBlock(), [tx1, tooMuch], MIN_MINING_DIFFICULTY)
+
+        testChain = chain.Chain()
+        with self.assertRaises(chain.UTXOException):
+            testChain.addBlock(b1)
+
+        # The amounts are still checked for assumed blocks.
+        testChain.assumeValid = {b1.hash, b1bad.hash}
+        with self.assertRaises(chain.UTXOException):
+            testChain.addBlock(b1bad)
+        testChain.addBlock(b1)
+        self.assertEqual(testChain.head.hash, b1.hash)
+
+
+def updateDiff(previous_block_diff, previous_blocks):
+    """
+    The retarget formula walking every block, as nodes computed it before
+    the tracker.
+    """
+    range_timestamps = 0
+    previous_block_timestamp = 0
+    range_count = len(previous_blocks)
+    for cblock in previous_blocks.values():
+        if cblock.timestamp is not None and cblock.index != 0:
+            nonce_time = cblock.timestamp - previous_block_timestamp
+            if nonce_time < MAX_CHANGING_INT:
+                range_timestamps += nonce_time
+            previous_block_timestamp = cblock.timestamp
+    average_block_mine = range_timestamps / range_count if range_count else BLOCK_TIME
+    minus_diff = average_block_mine / BLOCK_TIME
+    return int(MIN_MINING_DIFFICULTY + (previous_block_diff * MAX_CHANGING_DIFF) - (MAX_CHANGING_DIFF * minus_diff))
+
+
+class TestDifficultyTracker(unittest.TestCase):
+    def test_matchesUpdateDiff(self):
+        random.seed(4)
+        blocks = {}
+        tracker = chain.DifficultyTracker()
+        timestamp = time.time()
+        for index in range(600):
+            timestamp += random.uniform(0, 150)
+            newBlock = chain.block.Block(index % 120, timestamp, [], index, "0" * 64)
+            blocks[newBlock.hash] = newBlock
+            tracker.add(newBlock)
+            if index % 7 == 3:
+                # Recent blocks replay the ring buffer, older ones the chain.
+                recent = list(blocks)[-CHANGING_DIFF_TIME:]
+                removed = random.sample(recent if index % 14 == 3 else list(blocks), 2)
+                for blockHash in removed:
+                    del blocks[blockHash]
+                tracker.remove(removed, blocks)
+
+            self.assertLessEqual(len(tracker.recent), CHANGING_DIFF_TIME)
+            self.assertEqual(len(tracker), len(blocks))
+            for diff in (1, 6):
+                self.assertEqual(tracker.getUpdateDiff(diff), updateDiff(diff, blocks))
+
+    def test_pinsResults(self):
+        tracker = chain.DifficultyTracker()
+        for index, timestamp in enumerate([0, 1000, 1020, 1070, 1300, 1310]):
+            tracker.add(chain.block.Block(index, timestamp, [], index, "0" * 64))
+        # Times of 100 seconds or more are left out, (20 + 50 + 10) / 6 blocks
+        # is about 13 seconds per block.
+        self.assertEqual(tracker.getUpdateDiff(4), 18)
+        self.assertEqual(tracker.getUpdateDiff(7), 33)
+
+    def test_followsChain(self):
+        testChain = chain.Chain(reorgLimit=2)
+        b1 = createRewardBlock(testChain.head)
+        testChain.addBlock(b1)
+        b2alt = createRewardBlock(b1)
+        testChain.addBlock(b2alt)
+        b2 = createRewardBlock(b1)
+        testChain.addBlock(b2)
+        testChain.addBlock(createRewardBlock(b2))
+        testChain.addBlock(createRewardBlock(testChain.head))
+        self.assertEqual(len(testChain.difficulty), len(testChain.blocks))
+        self.assertEqual(
+            testChain.difficulty.getUpdateDiff(3), updateDiff(3, testChain.blocks))
+
+
+class TestAddressIndex(unittest.TestCase):
+    def test_followsSpendAndRevert(self):
+        manager = chain.UTXOManager()
+        tx1 = transaction.createTransaction([public1], [1000], time.time())
+        manager.spend(tx1)
+        self.assertEqual(manager.getBalance(public1), 1000)
+
+        tx2 = transaction.createTransaction(
+            outputAddresses=[public2, public1],
+            outputAmounts=[400, 600],
+            timestamp=time.time(),
+            previousTransactionHashes=[tx1.hash],
+            previousOutputIndices=[0],
+            privateKeys=[private1]
+        )
+        spent = manager.spend(tx2)
+        self.assertEqual(manager.getBalance(public1), 600)
+        self.assertEqual(manager.getBalance(public2), 400)
+        self.assertEqual(manager.getAddressOutputs(public1), [(tx2.hash, 1, 600)])
+        self.assertEqual(manager.getAddressOutputs(public1, offset=1), [])
+
+        manager.revert(tx2, spent)
+        self.assertEqual(manager.getAddressOutputs(public1), [(tx1.hash, 0, 1000)])
+        self.assertEqual(manager.getBalance(public2), 0)
+        self.assertEqual(manager.getAddressCount(public3), 0)
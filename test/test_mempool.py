@@ -0,0 +1,301 @@
+import unittest
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from AverCoin.blockchain import block, mine, transaction
+from AverCoin.node import mempool
+from AverCoin.test import private1, private2, public1, public2, public3
+
+
+def createSpend(amount=1000):
+    tx1 = transaction.createTransaction([public1], [amount], time.time())
+    tx2 = transaction.createTransaction(
+        [public2], [amount], time.time(), [tx1.hash], [0], [private1])
+    return tx1, tx2
+
+
+class TestMempool(unittest.TestCase):
+    def test_addAndRemove(self):
+        pool = mempool.Mempool()
+        coinbase, spend = createSpend()
+
+        self.assertFalse(pool.add(coinbase)[0])
+        self.assertTrue(pool.add(spend)[0])
+        self.assertFalse(pool.add(spend)[0])
+        self.assertEqual(pool.version, 1)
+        self.assertIn(spend.hash, pool)
+        self.assertEqual(pool.as_dicts(), [spend.asDict()])
+
+        self.assertTrue(pool.remove(spend.hash))
+        self.assertFalse(pool.remove(spend.hash))
+        self.assertEqual(pool.version, 2)
+        self.assertEqual(len(pool), 0)
+
+    def test_followsChain(self):
+        pool = mempool.Mempool()
+        coinbase, spend = createSpend()
+        _, pending = createSpend()
+        double = transaction.createTransaction(
+            [public1], [1000], time.time(), [coinbase.hash], [0], [private1])
+        self.assertTrue(pool.add(spend)[0])
+        self.assertTrue(pool.add(pending)[0])
+        self.assertFalse(pool.add(double)[0])
+        self.assertEqual(pool.get_spender(coinbase.hash, 0), spend.hash)
+
+        # Only the included transaction leaves the pool.
+        mined = mine.generateNextBlock(block.genesisBlock(), [coinbase, spend], 1)
+        pool.blockConnected(mined)
+        self.assertEqual(pool.transactions(), [pending])
+
+        # Disconnected transactions come back with the next connected block,
+        # which here evicts the spend again by spending the same output.
+        pool.blockDisconnected(mined)
+        conflicting = mine.generateNextBlock(block.genesisBlock(), [coinbase, double], 1)
+        pool.blockConnected(conflicting)
+        self.assertNotIn(spend.hash, pool)
+        self.assertIsNone(pool.get_spender(coinbase.hash, 0))
+        self.assertIn(pending.hash, pool)
+
+    def test_reorgEvictsOrphans(self):
+        poolChain = mempool.chain.Chain()
+        pool = mempool.Mempool(pool_chain=poolChain)
+        poolChain.addListener(pool)
+        load = lambda b: mempool.chain.block.createFromJSON(b.asJSON())
+        reward = lambda: transaction.createTransaction([public1], [250], time.time())
+
+        coinbase = reward()
+        split = transaction.createTransaction(
+            [public1, public1], [125, 125], time.time(), [coinbase.hash], [0], [private1])
+        b1 = mine.generateNextBlock(block.genesisBlock(), [coinbase, split], 1)
+        poolChain.addBlock(load(b1))
+
+        # The parent of child is mined only in the old branch, the parent of
+        # kept in both.
+        parent = transaction.createTransaction(
+            [public2], [125], time.time(), [split.hash], [0], [private1])
+        shared = transaction.createTransaction(
+            [public2], [125], time.time(), [split.hash], [1], [private1])
+        b2 = mine.generateNextBlock(b1, [reward(), parent, shared], 1)
+        poolChain.addBlock(load(b2))
+        child = transaction.createTransaction(
+            [public1], [125], time.time(), [parent.hash], [0], [private2])
+        kept = transaction.createTransaction(
+            [public1], [125], time.time(), [shared.hash], [0], [private2])
+        self.assertTrue(pool.add(child)[0])
+        self.assertTrue(pool.add(kept)[0])
+
+        double = transaction.createTransaction(
+            [public3], [125], time.time(), [split.hash], [0], [private1])
+        tip = mine.generateNextBlock(b1, [reward(), double, shared], 1)
+        poolChain.addBlock(load(tip))
+        while poolChain.isMainChain(b2):
+            tip = mine.generateNextBlock(tip, list(createSpend(250)), 1)
+            poolChain.addBlock(load(tip))
+
+        self.assertNotIn(parent.hash, pool)
+        self.assertNotIn(child.hash, pool)
+        self.assertEqual(pool.select(10), [kept])
+
+    def test_utxoAdmission(self):
+        poolChain = mempool.chain.Chain()
+        coinbase = transaction.createTransaction([public1], [250], time.time())
+        spend = transaction.createTransaction(
+            [public1], [250], time.time(), [coinbase.hash], [0], [private1])
+        mined = mine.generateNextBlock(block.genesisBlock(), [coinbase, spend], 1)
+        poolChain.addBlock(mempool.chain.block.createFromJSON(mined.asJSON()))
+        pool = mempool.Mempool(pool_chain=poolChain)
+
+        unknown = transaction.createTransaction(
+            [public2], [250], time.time(), [coinbase.hash], [0], [private1])
+        self.assertEqual(pool.add(unknown), (False, "Referenced UTXO does not exist."))
+        tooMuch = transaction.createTransaction(
+            [public2], [300], time.time(), [spend.hash], [0], [private1])
+        self.assertFalse(pool.add(tooMuch)[0])
+        badSignature = transaction.createTransaction(
+            [public2], [250], time.time(), [spend.hash], [0], [private2])
+        self.assertFalse(pool.add(badSignature)[0])
+
+        # A spend of a pending output is accepted on top of the chain.
+        child = transaction.createTransaction(
+            [public2], [250], time.time(), [spend.hash], [0], [private1])
+        grandchild = transaction.createTransaction(
+            [public1], [250], time.time(), [child.hash], [0], [private2])
+        self.assertTrue(pool.add(child)[0])
+        self.assertTrue(pool.add(grandchild)[0])
+
+        pool.evict(child.hash)
+        self.assertEqual(len(pool), 0)
+
+    def test_addBatch(self):
+        poolChain = mempool.chain.Chain()
+        coinbase = transaction.createTransaction([public1], [250], time.time())
+        spend = transaction.createTransaction(
+            [public1], [250], time.time(), [coinbase.hash], [0], [private1])
+        mined = mine.generateNextBlock(block.genesisBlock(), [coinbase, spend], 1)
+        poolChain.addBlock(mempool.chain.block.createFromJSON(mined.asJSON()))
+        pool = mempool.Mempool(pool_chain=poolChain)
+
+        child = transaction.createTransaction(
+            [public2], [250], time.time(), [spend.hash], [0], [private1])
+        grandchild = transaction.createTransaction(
+            [public1], [250], time.time(), [child.hash], [0], [private2])
+        forged = transaction.createTransaction(
+            [public2], [250], time.time(), [grandchild.hash], [0], [private2])
+        unknown = transaction.createTransaction(
+            [public2], [250], time.time(), [coinbase.hash], [0], [private1])
+
+        with ThreadPoolExecutor(2) as executor:
+            results = pool.add_batch(
+                [child, grandchild, child, forged, unknown, coinbase], executor)
+        self.assertEqual([is_valid for is_valid, _ in results], [True, True, False, False, False, False])
+        self.assertEqual(results[2], (False, "Duplicate transaction in the batch"))
+        self.assertEqual(results[3], (False, "Signature not valid"))
+        self.assertEqual(results[4], (False, "Referenced UTXO does not exist."))
+        self.assertEqual(pool.transactions(), [child, grandchild])
+
+    def test_addBatchMalformedSignature(self):
+        poolChain = mempool.chain.Chain()
+        coinbase = transaction.createTransaction([public1], [250], time.time())
+        spend = transaction.createTransaction(
+            [public1, public1], [125, 125], time.time(), [coinbase.hash], [0], [private1])
+        mined = mine.generateNextBlock(block.genesisBlock(), [coinbase, spend], 1)
+        poolChain.addBlock(mempool.chain.block.createFromJSON(mined.asJSON()))
+        pool = mempool.Mempool(pool_chain=poolChain)
+
+        first = transaction.createTransaction(
+            [public2], [125], time.time(), [spend.hash], [0], [private1])
+        second = transaction.createTransaction(
+            [public2], [125], time.time(), [spend.hash], [1], [private1])
+        malformed = transaction.createTransaction(
+            [public1], [125], time.time(), [first.hash], [0], [private2])
+        malformed.inputs[0].signature = "not hex"
+        malformed.hash = transaction.Transaction.createHash(
+            malformed.inputs, malformed.outputs, malformed.timestamp)
+
+        with ThreadPoolExecutor(2) as executor:
+            results = pool.add_batch([first, malformed, second], executor)
+        self.assertEqual(results, [
+            (True, "Transaction added"), (False, "Invalid signature"), (True, "Transaction added")])
+        self.assertEqual(pool.transactions(), [first, second])
+        self.assertEqual(pool.add(malformed), (False, "Invalid signature"))
+
+        # An index into a parent in the batch has to be an int.
+        third = transaction.createTransaction(
+            [public2], [125], time.time(), [spend.hash], [1], [private1])
+        child = transaction.createTransaction(
+            [public1], [125], time.time(), [third.hash], [0], [private2])
+        child.inputs[0].referencedOutputIndex = 0.0
+        child.hash = transaction.Transaction.createHash(
+            child.inputs, child.outputs, child.timestamp)
+        self.assertEqual(pool.add_batch([third, child])[1],
+                         (False, "Referenced UTXO does not exist."))
+
+    def test_selectOrder(self):
+        pool = mempool.Mempool()
+        coinbase, parent = createSpend()
+        child = transaction.createTransaction(
+            [public1], [1000], time.time(), [parent.hash], [0], [private2])
+        _, other = createSpend()
+
+        # The child arrives first and gets a higher fee, but still has to
+        # wait for its parent.
+        pool._insert(mempool.MempoolEntry(child, 1, fee=5))
+        pool._insert(mempool.MempoolEntry(other, 2, fee=1))
+        pool._insert(mempool.MempoolEntry(parent, 3))
+
+        self.assertEqual(
+            [tx.hash for tx in pool.select(10)], [other.hash, parent.hash, child.hash])
+        self.assertEqual([tx.hash for tx in pool.select(1)], [other.hash])
+
+        pool.remove(other.hash)
+        self.assertEqual([tx.hash for tx in pool.select(10)], [parent.hash, child.hash])
+
+    def test_budgetEviction(self):
+        pool = mempool.Mempool(max_count=3)
+        _, low = createSpend()
+        _, parent = createSpend()
+        child = transaction.createTransaction(
+            [public1], [1000], time.time(), [parent.hash], [0], [private2])
+        pool._insert(mempool.MempoolEntry(low, time.time(), fee=1))
+        self.assertTrue(pool.add(parent)[0])
+        self.assertTrue(pool.add(child)[0])
+
+        # A full pool keeps what it has over an equal newcomer.
+        _, late = createSpend()
+        self.assertEqual(pool.add(late), (False, "Mempool is full"))
+
+        # A better one evicts the newest of the lowest fee, the child, and
+        # then the parent takes the child along with it.
+        _, better = createSpend()
+        entry = mempool.MempoolEntry(better, time.time(), fee=5)
+        self.assertTrue(pool._make_room(entry))
+        self.assertEqual([tx.hash for tx in pool.transactions()], [low.hash, parent.hash])
+
+        pool = mempool.Mempool(max_count=10)
+        self.assertTrue(pool.add(parent)[0])
+        pool.max_bytes = pool.total_bytes + 10
+        self.assertEqual(pool.add(low), (False, "Mempool is full"))
+        pool.remove(parent.hash)
+        self.assertEqual(pool.total_bytes, 0)
+
+    def test_budgetEvictionIsAllOrNothing(self):
+        pool = mempool.Mempool(max_bytes=250)
+        _, cheap = createSpend()
+        _, dear = createSpend()
+        pool._insert(mempool.MempoolEntry(cheap, time.time(), fee=1, size=100))
+        pool._insert(mempool.MempoolEntry(dear, time.time(), fee=3, size=100))
+
+        # Fitting would take the dearer one as well, so the cheap one stays.
+        _, middle = createSpend()
+        entry = mempool.MempoolEntry(middle, time.time(), fee=2, size=200)
+        self.assertFalse(pool._make_room(entry))
+        self.assertEqual(pool.transactions(), [cheap, dear])
+
+        # A child whose parent would have to go keeps the parent.
+        child = transaction.createTransaction(
+            [public1], [1000], time.time(), [cheap.hash], [0], [private2])
+        entry = mempool.MempoolEntry(child, time.time(), fee=4, size=100)
+        self.assertFalse(pool._make_room(entry))
+        self.assertEqual(pool.transactions(), [cheap, dear])
+
+        entry = mempool.MempoolEntry(middle, time.time(), fee=5, size=200)
+        self.assertTrue(pool._make_room(entry))
+        self.assertEqual(pool.transactions(), [])
+        self.assertEqual(pool.total_bytes, 0)
+
+    def test_expiry(self):
+        pool = mempool.Mempool(ttl=60)
+        _, parent = createSpend()
+        child = transaction.createTransaction(
+            [public1], [1000], time.time(), [parent.hash], [0], [private2])
+        _, fresh = createSpend()
+        pool._insert(mempool.MempoolEntry(parent, time.time() - 120))
+        pool._insert(mempool.MempoolEntry(child, time.time()))
+
+        # The child goes with its expired parent.
+        self.assertTrue(pool.add(fresh)[0])
+        self.assertEqual(pool.transactions(), [fresh])
+        pool.expire(time.time() + 61)
+        self.assertEqual(len(pool), 0)
+
+    def test_journal(self):
+        _, spend1 = createSpend()
+        _, spend2 = createSpend()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mempool.journal")
+            pool = mempool.Mempool(path)
+            pool.add(spend1)
+            pool.add(spend2)
+            pool.remove(spend1.hash)
+            pool.close()
+
+            with open(path, "a") as f:
+                f.write('{"add": {"inp')
+
+            # Removed entries and the torn line are compacted away.
+            pool = mempool.Mempool(path)
+            self.assertEqual([tx.hash for tx in pool.transactions()], [spend2.hash])
+            pool.close()
+            with open(path) as f:
+                self.assertEqual(len(f.readlines()), 1)
@@ -109,4 +109,28 @@ class TestTransaction(unittest.TestCase):
             transaction.createTransaction(
                 outputAddresses=[public1],
                 outputAmounts=[0],
-                timestamp=time.time())
\ No newline at end of file
+                timestamp=time.time())
+
+    def test_verifierCache(self):
+        coinbase = transaction.createTransaction([public1], [1000], time.time())
+        spend = transaction.createTransaction(
+            [public2], [1000], time.time(), [coinbase.hash], [0], [private1])
+        other = transaction.createTransaction(
+            [public3], [1000], time.time(), [coinbase.hash], [0], [private1])
+
+        transaction.getVerifier.cache_clear()
+        transaction.signatureCache.clear()
+        for _ in range(3):
+            self.assertTrue(transaction.verifyInputSignature(public1, spend, 0)[0])
+        serialized = transaction.TransactionOutput.serializeMultiple(other.outputs)
+        self.assertTrue(transaction.verifyInputSignature(public1, other, 0, serialized)[0])
+
+        # The key is parsed once and each signature verified once.
+        info = transaction.getVerifier.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+        self.assertEqual(len(transaction.signatureCache), 2)
+
+        # A verified signature does not pass for another address.
+        self.assertFalse(transaction.verifyInputSignature(public2, spend, 0)[0])
+        transaction.signatureCache.evictTransaction(spend)
+        self.assertEqual(len(transaction.signatureCache), 1)
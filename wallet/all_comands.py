@@ -7,6 +7,7 @@ sys.path.append(os.path.abspath('../node'))
 
 import transaction
 import time
+from constants import MIN_TRANSACTION_AMOUNT
 
 wallet_commands = ["keys",
                    "import_keys",
@@ -34,7 +35,7 @@ node_commands = ["sync",
                  "get_transaction transactionHash",
                  "add_transaction amount address",
                  "get_pending_transactions",
-
+                 "balance",
                  ]
 node_use_cmd = ["Проверка синхронизации (путем сравнивая количество блоков у клиента и ноды",
                 "возвращает текущую сложность",
@@ -49,6 +50,7 @@ node_use_cmd = ["Проверка синхронизации (путем сра
                 "возвращает транзакцию по хешу транзакции",
                 "добавляется транзакция при передачи в формате транзакции",
                 "возвращаются pending транзакции",
+                "возвращает баланс кошелька",
                 ]
 
 
@@ -113,16 +115,71 @@ async def get_transaction(ip, port, tx_hash):
         print(err)
 
 
+async def get_utxos(ip, port, address, offset=0, limit=100):
+    try:
+        r2 = requests.get(f"http://{ip}:{port}/get_utxos", params={"address": address, "offset": offset, "limit": limit})
+        data2 = r2.text
+        j2 = json.loads(data2)
+        return j2["result"]
+    except Exception as err:
+        print(err)
+
+
+async def get_balance(ip, port, address):
+    try:
+        r2 = requests.get(f"http://{ip}:{port}/get_balance", params={"address": address})
+        data2 = r2.text
+        j2 = json.loads(data2)
+        return j2["result"]
+    except Exception as err:
+        print(err)
+
+
 async def add_transaction(ip, port, private1, amount, address):
     try:
-        pending_data = await get_pending_transactions(ip, port)
+        amount = int(amount)
+        own_address = private1.publickey().exportKey('DER').hex()
+
+        # Collect unspent outputs of the wallet until they cover the amount
+        # and the change is either nothing or a valid output.
+        def needs_more(collected):
+            return collected < amount or 0 < collected - amount < MIN_TRANSACTION_AMOUNT
+
+        previous_hashes = []
+        previous_indices = []
+        collected = 0
+        offset = 0
+        while needs_more(collected):
+            page = await get_utxos(ip, port, own_address, offset)
+            if not page["outputs"]:
+                if collected < amount:
+                    print("Недостаточно средств")
+                    return False
+                # No more outputs, the dust change goes with the payment.
+                amount = collected
+                break
+            for output in page["outputs"]:
+                previous_hashes.append(output["hash"])
+                previous_indices.append(output["index"])
+                collected += output["amount"]
+                if not needs_more(collected):
+                    break
+            offset += len(page["outputs"])
+
+        output_addresses = [address]
+        output_amounts = [amount]
+        if collected > amount:
+            # Inputs have to match outputs, the rest goes back as change.
+            output_addresses.append(own_address)
+            output_amounts.append(collected - amount)
+
         tx2 = transaction.createTransaction(
-            outputAddresses=[address],
-            outputAmounts=[int(amount)],
+            outputAddresses=output_addresses,
+            outputAmounts=output_amounts,
             timestamp=time.time(),
-            previousTransactionHashes=["2780823b189d25158c83cd83dc4a8931a8c7b4b1a64a68f64f8710a88ea92207"],
-            previousOutputIndices=[0],
-            privateKeys=[private1]
+            previousTransactionHashes=previous_hashes,
+            previousOutputIndices=previous_indices,
+            privateKeys=[private1] * len(previous_hashes)
         )
         print(tx2)
         r2 = requests.get(f"http://{ip}:{port}/add_transaction?pending_transaction={tx2}")
@@ -80,6 +80,9 @@ def commands(file):
             print(asyncio.run(get_last_index(STANDART_IP, STANDART_PORT)))
         elif msg == "get_last_hash":
             print(asyncio.run(get_last_hash(STANDART_IP, STANDART_PORT)))
+        elif msg == "balance":
+            wallet_keys = read_json(f"wallets/{file}")
+            print(asyncio.run(get_balance(STANDART_IP, STANDART_PORT, wallet_keys["public_key"])))
         elif msg == "/exit":
             sys.exit()
 